@@ -10,7 +10,7 @@ if sys.version_info.major < 3:
 
 from . import parts
 from .vehicle import Vehicle
-from .memory import Memory
+from .memory import Memory, SlotMemory
 from . import utils
 from . import config
 from . import contrib
@@ -10,8 +10,6 @@ import time
 import donkeycar as dk
 from donkeycar.parts.datastore import Tub
 from donkeycar.utils import *
-from donkeycar.management.tub import TubManager
-from donkeycar.management.joystick_creator import CreateJoystick
 import numpy as np
 
 PACKAGE_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
@@ -524,32 +522,193 @@ class Sim(BaseCommand):
 
 
 
+class TubClean(BaseCommand):
+    '''
+    the tub manager pulls in tornado, so it's only imported when used.
+    '''
+    def run(self, args):
+        from donkeycar.management.tub import TubManager
+        TubManager().run(args)
+
+
+class CreateJs(BaseCommand):
+    def run(self, args):
+        from donkeycar.management.joystick_creator import CreateJoystick
+        CreateJoystick().run(args)
+
+
 class TubCheck(BaseCommand):
     def parse_args(self, args):
         parser = argparse.ArgumentParser(prog='tubcheck', usage='%(prog)s [options]')
         parser.add_argument('tubs', nargs='+', help='paths to tubs')
         parser.add_argument('--fix', action='store_true', help='remove problem records')
         parser.add_argument('--delete_empty', action='store_true', help='delete tub dir with no records')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='processes to check records with. default: one per cpu')
+        parser.add_argument('--recheck', action='store_true', help='check every record, not only new or changed ones')
         parsed_args = parser.parse_args(args)
         return parsed_args
 
-    def check(self, tub_paths, fix=False, delete_empty=False):
+    def check(self, tub_paths, fix=False, delete_empty=False, workers=1, recheck=False):
         '''
         Check for any problems. Looks at tubs and find problems in any records or images that won't open.
         If fix is True, then delete images and records that cause problems.
         '''
+        from concurrent.futures import ProcessPoolExecutor
         tubs = [Tub(path) for path in tub_paths]
+        pool = ProcessPoolExecutor(max_workers=workers) if workers and workers > 1 else None
+
+        start = time.time()
+        num_records = 0
+        try:
+            for tub in tubs:
+                tub.check(fix=fix, pool=pool, use_cache=not recheck)
+                num_records += tub.get_num_records()
+                if delete_empty and tub.get_num_records() == 0:
+                    import shutil
+                    print("removing empty tub", tub.path)
+                    shutil.rmtree(tub.path)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        elapsed = time.time() - start
+        print('Checked %d tubs, %d records, in %.1f sec (%.0f records/sec).' %
+              (len(tubs), num_records, elapsed, num_records / max(elapsed, 1e-6)))
+
+    def run(self, args):
+        args = self.parse_args(args)
+        self.check(args.tubs, args.fix, args.delete_empty, args.workers, args.recheck)
+
+
+class TubManifest(BaseCommand):
+    def parse_args(self, args):
+        parser = argparse.ArgumentParser(prog='tubmanifest', usage='%(prog)s [options]')
+        parser.add_argument('tubs', nargs='+', help='paths to tubs')
+        parser.add_argument('--force', action='store_true', help='rebuild manifests that already exist')
+        parsed_args = parser.parse_args(args)
+        return parsed_args
+
+    def run(self, args):
+        args = self.parse_args(args)
+        for path in args.tubs:
+            tub = Tub(path)
+            if tub.manifest is not None and not args.force:
+                print('%s already has a manifest. use --force to rebuild it.' % tub.path)
+                continue
+            start = time.time()
+            manifest = tub.rebuild_manifest()
+            print('%s: %d records indexed in %.1f sec' % (tub.path, manifest.count(), time.time() - start))
+
+
+class TubConvert(BaseCommand):
+    def parse_args(self, args):
+        parser = argparse.ArgumentParser(prog='tubconvert', usage='%(prog)s [options]')
+        parser.add_argument('tub', help='path to the tub to convert')
+        parser.add_argument('out', help='path of the new tub')
+        parser.add_argument('--format', default='chunked', choices=['chunked', 'files'], help='format of the new tub')
+        parser.add_argument('--chunk_size', type=int, default=1000, help='records per chunk in a chunked tub')
+        parsed_args = parser.parse_args(args)
+        return parsed_args
+
+    def run(self, args):
+        from donkeycar.parts.datastore import convert_tub
+        args = self.parse_args(args)
+        start = time.time()
+        tub = convert_tub(args.tub, args.out, tub_format=args.format, chunk_size=args.chunk_size)
+        print('converted %d records to %s in %.1f sec' % (tub.get_num_records(), tub.path, time.time() - start))
+
+
+class TubEncode(BaseCommand):
+    '''
+    Encode the raw frames of tubs recorded with TUB_FORMAT = 'raw' into
+    jpgs, replacing each raw tub with a chunked or files tub.
+    '''
+    def parse_args(self, args):
+        parser = argparse.ArgumentParser(prog='tubencode', usage='%(prog)s [options]')
+        parser.add_argument('tubs', nargs='+', help='paths to raw tubs')
+        parser.add_argument('--format', default='chunked', choices=['chunked', 'files'], help='format of the encoded tubs')
+        parser.add_argument('--keep_raw', action='store_true', help='keep the raw tub, renamed to <tub>.raw')
+        parsed_args = parser.parse_args(args)
+        return parsed_args
+
+    def encode(self, path, tub_format='chunked', keep_raw=False):
+        from donkeycar.parts.datastore import convert_tub
+        path = os.path.abspath(os.path.expanduser(path)).rstrip(os.sep)
+        tub = Tub(path)
+        if tub.meta.get('format') != 'raw':
+            print('%s is not a raw tub, skipping.' % path)
+            return
+        start = time.time()
+        encoded = convert_tub(path, path + '.encoding', tub_format=tub_format,
+                              chunk_size=tub.meta.get('chunk_size', 1000))
+        #swap the encoded tub in only once it's complete.
+        os.rename(path, path + '.raw')
+        os.rename(encoded.path, path)
+        if not keep_raw:
+            shutil.rmtree(path + '.raw')
+        print('%s: encoded %d records in %.1f sec' % (path, encoded.get_num_records(), time.time() - start))
+
+    def run(self, args):
+        args = self.parse_args(args)
+        for path in args.tubs:
+            self.encode(path, args.format, args.keep_raw)
 
-        for tub in tubs:
-            tub.check(fix=fix)
-            if delete_empty and tub.get_num_records() == 0:
-                import shutil
-                print("removing empty tub", tub.path)
-                shutil.rmtree(tub.path)
+
+class TubCompact(BaseCommand):
+    '''
+    Rewrite tubs as dense tubs, dropping excluded and unreadable records
+    and images no record uses, and numbering records from 1.
+    '''
+    def parse_args(self, args):
+        parser = argparse.ArgumentParser(prog='tubcompact', usage='%(prog)s [options]')
+        parser.add_argument('tubs', nargs='+', help='paths to tubs')
+        parser.add_argument('--format', default=None, choices=['files', 'chunked', 'raw'], help='format of the compacted tubs. default: keep their format')
+        parser.add_argument('--size', default=None, help='resize images to WxH, like 160x120')
+        parser.add_argument('--keep_old', action='store_true', help='keep the old tub, renamed to <tub>.old')
+        parsed_args = parser.parse_args(args)
+        return parsed_args
 
     def run(self, args):
+        from donkeycar.parts.datastore import compact_tub
         args = self.parse_args(args)
-        self.check(args.tubs, args.fix, args.delete_empty)
+        image_size = None
+        if args.size:
+            image_size = tuple(int(n) for n in args.size.lower().split('x'))
+        for path in args.tubs:
+            start = time.time()
+            before = Tub(path)
+            num_before = before.get_num_records()
+            before.shutdown()
+            try:
+                tub = compact_tub(path, tub_format=args.format, image_size=image_size, keep_old=args.keep_old)
+            except FileExistsError as e:
+                print('%s: skipped, %s' % (path, e))
+                continue
+            print('%s: kept %d of %d records in %.1f sec' % (tub.path, tub.get_num_records(), num_before, time.time() - start))
+
+
+class MakeDataset(BaseCommand):
+    '''
+    Compile tubs into a memory mapped dataset for train.py --dataset
+    '''
+    def parse_args(self, args):
+        parser = argparse.ArgumentParser(prog='makedataset', usage='%(prog)s [options]')
+        parser.add_argument('--tub', nargs='+', help='paths to tubs')
+        parser.add_argument('--out', help='path of the dataset to create')
+        parser.add_argument('--config', default='./config.py', help='location of config file to use. default: ./config.py')
+        parsed_args = parser.parse_args(args)
+        return parsed_args
+
+    def run(self, args):
+        from donkeycar.parts.dataset import build_dataset
+        args = self.parse_args(args)
+        if not args.tub or not args.out:
+            print('makedataset needs --tub and --out')
+            return
+        cfg = load_config(args.config)
+        if cfg is None:
+            return
+        build_dataset(cfg, args.tub, args.out)
 
 
 class ShowHistogram(BaseCommand):
@@ -748,10 +907,11 @@ class ShowPredictionPlots(BaseCommand):
         num_records = len(records)
         print('processing %d records:' % num_records)
 
+        from donkeycar.parts.datastore import load_json_record
         for record_path in records:
-            with open(record_path, 'r') as fp:
-                record = json.load(fp)
-            img_filename = os.path.join(tub_paths, record['cam/image_array'])
+            #chunked tubs have no file per record, so read it through the tub.
+            record = load_json_record(record_path)
+            img_filename = os.path.join(os.path.dirname(record_path), record['cam/image_array'])
             img = load_scaled_image_arr(img_filename, cfg)
             user_angle = float(record["user/angle"])
             user_throttle = float(record["user/throttle"])
@@ -799,6 +959,87 @@ class ShowPredictionPlots(BaseCommand):
         self.plot_predictions(cfg, args.tub, args.model, args.limit, args.type)
         
 
+class ImportTime(BaseCommand):
+    '''
+    Report how long it takes to import donkeycar modules from a cold start,
+    using python -X importtime in a fresh interpreter for each module.
+    '''
+    #modules that take a long time to import and should only be imported
+    #on the code paths that need them.
+    HEAVY_MODULES = ['pandas', 'PIL', 'tornado', 'keras', 'tensorflow', 'cv2',
+                     'matplotlib', 'sklearn', 'moviepy', 'scipy']
+
+    DEFAULT_MODULES = ['donkeycar', 'donkeycar.parts.datastore', 'donkeycar.parts.camera',
+                       'donkeycar.parts.actuator', 'donkeycar.parts.controller',
+                       'donkeycar.management.base']
+
+    def parse_args(self, args):
+        parser = argparse.ArgumentParser(prog='importtime', usage='%(prog)s [options]')
+        parser.add_argument('modules', nargs='*', help='modules to import. Default: the core donkeycar modules')
+        parser.add_argument('--top', type=int, default=10, help='number of slowest imports to list per module')
+        parsed_args = parser.parse_args(args)
+        return parsed_args
+
+    def measure(self, module, startup=()):
+        '''
+        import the module in a new interpreter and return the total import
+        time in ms, a list of (cumulative ms, self ms, name) for each
+        module it imported, and an error if the import failed. Modules in
+        startup, imported by the interpreter itself, aren't counted.
+        '''
+        import subprocess
+        statement = 'import ' + module if module else 'pass'
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+        imports = []
+        total = 0.0
+        errors = []
+        for line in proc.stderr.splitlines():
+            if not line.startswith('import time:'):
+                errors.append(line)
+                continue
+            fields = line[len('import time:'):].split('|')
+            if len(fields) != 3 or not fields[0].strip().isdigit():
+                continue
+            self_ms = int(fields[0]) / 1000.0
+            cum_ms = int(fields[1]) / 1000.0
+            name = fields[2].rstrip()
+            if name.strip() in startup:
+                continue
+            #nested imports are indented, top level ones only by one space.
+            if len(name) - len(name.lstrip()) == 1:
+                total += cum_ms
+            imports.append((cum_ms, self_ms, name.strip()))
+        error = errors[-1] if proc.returncode != 0 and errors else None
+        return total, imports, error
+
+    def run(self, args):
+        from prettytable import PrettyTable
+        args = self.parse_args(args)
+        modules = args.modules or self.DEFAULT_MODULES
+        _, startup, _ = self.measure(None)
+        startup = set(name for _, _, name in startup)
+
+        summary = PrettyTable()
+        summary.field_names = ["module", "total ms", "heavy imports"]
+        for module in modules:
+            total, imports, error = self.measure(module, startup)
+            names = set(name for _, _, name in imports)
+            heavy = [m for m in self.HEAVY_MODULES if m in names]
+            summary.add_row([module, "%.1f" % total, ', '.join(heavy) if error is None else error])
+
+            pt = PrettyTable()
+            pt.field_names = ["import", "cumulative ms", "self ms"]
+            for cum_ms, self_ms, name in sorted(imports, reverse=True)[:args.top]:
+                pt.add_row([name, "%.1f" % cum_ms, "%.1f" % self_ms])
+            print("Slowest imports for %s:" % module)
+            print(pt)
+
+        print("Import Time Summary:")
+        print(summary)
+
+
 def execute_from_command_line():
     """
     This is the fuction linked to the "donkey" terminal command.
@@ -807,16 +1048,22 @@ def execute_from_command_line():
             'createcar': CreateCar,
             'findcar': FindCar,
             'calibrate': CalibrateCar,
-            'tubclean': TubManager,
+            'tubclean': TubClean,
             'tubhist': ShowHistogram,
             'tubplot': ShowPredictionPlots,
             'tubcheck': TubCheck,
+            'tubconvert': TubConvert,
+            'tubencode': TubEncode,
+            'tubcompact': TubCompact,
+            'tubmanifest': TubManifest,
+            'makedataset': MakeDataset,
             'makemovie': MakeMovie,            
             'sim': Sim,
-            'createjs': CreateJoystick,
+            'createjs': CreateJs,
             'consync': ConSync,
             'contrain': ConTrain,
             'cnnactivations': ShowCnnActivations,
+            'importtime': ImportTime,
                 }
     
     args = sys.argv[:]
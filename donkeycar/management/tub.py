@@ -31,6 +31,8 @@ class WebServer(tornado.web.Application):
             (r"/", tornado.web.RedirectHandler, dict(url="/tubs")),
             (r"/tubs", TubsView, dict(data_path=data_path)),
             (r"/tubs/?(?P<tub_id>[^/]+)?", TubView),
+            (r"/api/tubs/(?P<tub_id>[^/]+)/records/(?P<ix>\d+)", TubRecordApi, dict(data_path=data_path)),
+            (r"/api/tubs/(?P<tub_id>[^/]+)/images/(?P<ix>\d+)", TubImageApi, dict(data_path=data_path)),
             (r"/api/tubs/?(?P<tub_id>[^/]+)?", TubApi, dict(data_path=data_path)),
             (r"/static/(.*)", tornado.web.StaticFileHandler, {"path": static_file_path}),
             (r"/tub_data/(.*)", tornado.web.StaticFileHandler, {"path": data_path}),
@@ -67,34 +69,31 @@ class TubView(tornado.web.RequestHandler):
         self.render("tub_web/tub.html", **data)
 
 
-class TubApi(tornado.web.RequestHandler):
-
-    def initialize(self, data_path):
-        self.data_path = data_path
+#tubs opened by the api, so serving each frame doesn't reopen its tub.
+open_tubs = {}
 
-    def image_path(self, tub_path, frame_id):
-        return os.path.join(tub_path, str(frame_id) + "_cam-image_array_.jpg")
 
-    def record_path(self, tub_path, frame_id):
-        return os.path.join(tub_path, "record_" + frame_id + ".json")
+def get_tub(tub_path):
+    from donkeycar.parts.datastore import Tub
+    tub = open_tubs.get(tub_path)
+    if tub is None:
+        tub = open_tubs[tub_path] = Tub(tub_path)
+    return tub
 
-    def clips_of_tub(self, tub_path):
-        seqs = [ int(f.split("_")[0]) for f in os.listdir(tub_path) if f.endswith('.jpg') ]
-        seqs.sort()
 
-        entries = ((os.stat(self.image_path(tub_path, seq))[ST_ATIME], seq) for seq in seqs)
+class TubApi(tornado.web.RequestHandler):
 
-        (last_ts, seq) = next(entries)
-        clips = [[seq]]
-        for next_ts, next_seq in entries:
-            #if next_ts - last_ts > 100:  #greater than 1s apart
-            #    clips.append([next_seq])
-            #else:
-            #    clips[-1].append(next_seq)
-            clips[-1].append(next_seq)
-            last_ts = next_ts
+    def initialize(self, data_path):
+        self.data_path = data_path
 
-        return clips
+    def clips_of_tub(self, tub_path):
+        #the tub's records, leaving out excluded and erased ones, whatever
+        #format the tub is in.
+        tub = get_tub(tub_path)
+        seqs = [ix for ix in tub.get_index(shuffled=False) if ix not in tub.exclude]
+        if not seqs:
+            return []
+        return [seqs]
 
     def get(self, tub_id):
         clips = self.clips_of_tub(os.path.join(self.data_path, tub_id))
@@ -111,6 +110,51 @@ class TubApi(tornado.web.RequestHandler):
         old_frames = list(itertools.chain(*old_clips))
         new_frames = list(itertools.chain(*new_clips['clips']))
         frames_to_delete = [str(item) for item in old_frames if item not in new_frames]
+        tub = get_tub(tub_path)
         for frm in frames_to_delete:
-            os.remove(self.record_path(tub_path, frm))
-            os.remove(self.image_path(tub_path, frm))
+            #removed through the tub so its manifest stays up to date. files
+            #tubs delete the record's image, chunked tubs exclude it.
+            tub.remove_record(int(frm))
+
+
+class TubRecordApi(tornado.web.RequestHandler):
+
+    def initialize(self, data_path):
+        self.data_path = data_path
+
+    def get(self, tub_id, ix):
+        tub = get_tub(os.path.join(self.data_path, tub_id))
+        try:
+            record = tub.get_raw_json_record(int(ix))
+        except FileNotFoundError:
+            raise tornado.web.HTTPError(404)
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(json.dumps(record))
+
+
+class TubImageApi(tornado.web.RequestHandler):
+    '''
+    the camera image of a record, read from its own file or from a chunk.
+    '''
+    def initialize(self, data_path):
+        self.data_path = data_path
+
+    def get(self, tub_id, ix):
+        from donkeycar.parts.datastore import RAW_FRAME_REF, read_frame, read_image_bytes
+        tub = get_tub(os.path.join(self.data_path, tub_id))
+        try:
+            ref = tub.get_json_record(int(ix))['cam/image_array']
+        except (FileNotFoundError, KeyError):
+            raise tornado.web.HTTPError(404)
+
+        if RAW_FRAME_REF.match(ref) is not None:
+            #raw frames aren't encoded, so make a jpg of them.
+            from io import BytesIO
+            from PIL import Image
+            buf = BytesIO()
+            Image.fromarray(read_frame(ref)).save(buf, format='jpeg')
+            data = buf.getvalue()
+        else:
+            data = read_image_bytes(ref)
+        self.set_header("Content-Type", "image/jpeg")
+        self.write(data)
@@ -56,4 +56,114 @@ class Memory:
         return self.d.values()
     
     def iteritems(self):
-        return self.d.iteritems()
\ No newline at end of file
+        return self.d.iteritems()
+
+    def reader(self, keys):
+        '''
+        return a function that gets the values for keys from memory.
+        The vehicle calls this once per part when it is added.
+        '''
+        keys = list(keys)
+        return lambda: self.get(keys)
+
+    def writer(self, keys):
+        '''
+        return a function that puts part outputs to keys in memory.
+        '''
+        keys = list(keys)
+        return lambda outputs: self.put(keys, outputs)
+
+
+class SlotMemory(Memory):
+    """
+    A Memory that keeps values in a flat list instead of a dict.
+    Channel names are resolved to integer slots once, when a part is
+    added to the vehicle, so the drive loop only does list indexing.
+    The dict style api of Memory still works for code outside the loop.
+    """
+    def __init__(self, *args, **kw):
+        self.slots = {}
+        self.vals = []
+
+    def slot(self, key):
+        '''
+        return the slot index of a channel, allocating one if needed.
+        '''
+        ix = self.slots.get(key)
+        if ix is None:
+            ix = len(self.vals)
+            self.slots[key] = ix
+            self.vals.append(None)
+        return ix
+
+    def bind(self, keys):
+        return tuple(self.slot(k) for k in keys)
+
+    @property
+    def d(self):
+        return {k: self.vals[i] for k, i in self.slots.items()}
+
+    def __setitem__(self, key, value):
+        if type(key) is not tuple:
+            key = (key,)
+            value = (value,)
+
+        for i, k in enumerate(key):
+            self.vals[self.slot(k)] = value[i]
+
+    def __getitem__(self, key):
+        if type(key) is tuple:
+            return [self.vals[self.slots[k]] for k in key]
+        else:
+            return self.vals[self.slots[key]]
+
+    def update(self, new_d):
+        for k, v in new_d.items():
+            self.vals[self.slot(k)] = v
+
+    def put(self, keys, inputs):
+        self.writer(keys)(inputs)
+
+    def get(self, keys):
+        return self.reader(keys)()
+
+    def keys(self):
+        return self.slots.keys()
+
+    def values(self):
+        return [self.vals[i] for i in self.slots.values()]
+
+    def reader(self, keys):
+        vals = self.vals
+        slots = self.bind(keys)
+
+        if len(slots) == 0:
+            return lambda: []
+        elif len(slots) == 1:
+            ix = slots[0]
+            return lambda: [vals[ix]]
+        else:
+            return lambda: [vals[i] for i in slots]
+
+    def writer(self, keys):
+        vals = self.vals
+        slots = self.bind(keys)
+
+        if len(slots) == 0:
+            return lambda outputs: None
+        elif len(slots) == 1:
+            ix = slots[0]
+
+            def write_one(outputs):
+                vals[ix] = outputs
+
+            return write_one
+
+        def write_many(outputs):
+            if len(outputs) < len(slots):
+                error = 'issue with keys: ' + str(list(keys)[len(outputs):])
+                raise IndexError(error)
+            for i, ix in enumerate(slots):
+                vals[ix] = outputs[i]
+
+        return write_many
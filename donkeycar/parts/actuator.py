@@ -449,6 +449,9 @@ class MockController(object):
     def __init__(self):
         pass
 
+    def set_pulse(self, pulse):
+        pass
+
     def run(self, pulse):
         pass
 
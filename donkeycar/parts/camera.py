@@ -1,16 +1,53 @@
 import os
 import time
 import numpy as np
-from PIL import Image
 import glob
+import threading
 from donkeycar.utils import rgb2gray
 
+#notified whenever any camera publishes a frame.
+frame_published = threading.Condition()
+
 class BaseCamera:
+    '''
+    Threaded cameras publish each new frame with publish_frame, which gives
+    it a sequence number, frame_id, and a capture time, frame_time. The
+    vehicle compares frame_id between loops so parts triggered by the
+    camera channel don't run again on a frame they've already seen, and
+    can use wait_for_frame to start a loop as soon as a frame arrives.
+    A frame_id of None means the camera doesn't track its frames.
+
+    Cameras that call publish_frame set publishes_frames, so only they are
+    used to start loops. Others would leave every loop waiting out the
+    timeout.
+    '''
+    frame_id = None
+    frame_time = None
+    publishes_frames = False
+
+    def publish_frame(self, frame):
+        with frame_published:
+            self.frame_time = time.time()
+            self.frame = frame
+            self.frame_id = (self.frame_id or 0) + 1
+            frame_published.notify_all()
+
+    def wait_for_frame(self, last_id, timeout=None):
+        '''
+        wait until there is a frame newer than last_id. Returns False if
+        timeout seconds passed first.
+        '''
+        with frame_published:
+            return frame_published.wait_for(
+                lambda: self.frame_id is not None and self.frame_id != last_id,
+                timeout)
 
     def run_threaded(self):
         return self.frame
 
 class PiCamera(BaseCamera):
+    publishes_frames = True
+
     def __init__(self, image_w=160, image_h=120, image_d=3, framerate=20):
         from picamera.array import PiRGBArray
         from picamera import PiCamera
@@ -47,11 +84,13 @@ class PiCamera(BaseCamera):
         for f in self.stream:
             # grab the frame from the stream and clear the stream in
             # preparation for the next frame
-            self.frame = f.array
+            frame = f.array
             self.rawCapture.truncate(0)
 
             if self.image_d == 1:
-                self.frame = rgb2gray(self.frame)
+                frame = rgb2gray(frame)
+
+            self.publish_frame(frame)
 
             # if the thread indicator variable is set, stop the thread
             if not self.on:
@@ -67,6 +106,8 @@ class PiCamera(BaseCamera):
         self.camera.close()
 
 class Webcam(BaseCamera):
+    publishes_frames = True
+
     def __init__(self, image_w=160, image_h=120, image_d=3, framerate = 20, iCam = 0):
         import pygame
         import pygame.camera
@@ -103,9 +144,10 @@ class Webcam(BaseCamera):
                 # self.frame = list(pygame.image.tostring(snapshot, "RGB", False))
                 snapshot = self.cam.get_image()
                 snapshot1 = pygame.transform.scale(snapshot, self.resolution)
-                self.frame = pygame.surfarray.pixels3d(pygame.transform.rotate(pygame.transform.flip(snapshot1, True, False), 90))
+                frame = pygame.surfarray.pixels3d(pygame.transform.rotate(pygame.transform.flip(snapshot1, True, False), 90))
                 if self.image_d == 1:
-                    self.frame = rgb2gray(self.frame)
+                    frame = rgb2gray(frame)
+                self.publish_frame(frame)
 
             stop = datetime.now()
             s = 1 / self.framerate - (stop - start).total_seconds()
@@ -131,6 +173,7 @@ class MockCamera(BaseCamera):
         if image is not None:
             self.frame = image
         else:
+            from PIL import Image
             self.frame = Image.new('RGB', (image_w, image_h))
 
     def update(self):
@@ -170,6 +213,7 @@ class ImageListCamera(BaseCamera):
 
     def run_threaded(self):        
         if self.num_images > 0:
+            from PIL import Image
             self.i_frame = (self.i_frame + 1) % self.num_images
             self.frame = Image.open(self.image_filenames[self.i_frame]) 
 
@@ -1,6 +1,7 @@
 import time
 import cv2
 import numpy as np
+from donkeycar.parts.camera import BaseCamera
 
 class ImgGreyscale():
 
@@ -222,7 +223,9 @@ class Pipeline():
             val = f(val, *args, **kwargs)
         return val
     
-class CvCam(object):
+class CvCam(BaseCamera):
+    publishes_frames = True
+
     def __init__(self, image_w=160, image_h=120, image_d=3, iCam=0):
 
         self.frame = None
@@ -233,7 +236,9 @@ class CvCam(object):
 
     def poll(self):
         if self.cap.isOpened():
-            ret, self.frame = self.cap.read()
+            ret, frame = self.cap.read()
+            if ret:
+                self.publish_frame(frame)
 
     def update(self):
         '''
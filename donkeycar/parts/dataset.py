@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Compile tubs into a training dataset that can be memory mapped, so
+training slices batches out of arrays instead of reading a json file and
+decoding a jpg for every record, every epoch.
+
+A dataset is a directory of .npy files, one per column, with a row per
+record, and a dataset.json describing them:
+
+    images.npy      uint8 (N, IMAGE_H, IMAGE_W, IMAGE_DEPTH), resized like
+                    load_scaled_image_arr does
+    angle.npy       float32 (N,) user/angle
+    throttle.npy    float32 (N,) user/throttle
+    imu.npy         float32 (N, 6) imu/acl_x..imu/gyr_z, nan when missing
+    behavior.npy    float32 (N, B) behavior/one_hot_state_array, when recorded
+    milliseconds.npy int64 (N,)
+    tub.npy         int32 (N,) position of the record's tub in dataset.json
+    index.npy       int64 (N,) the record's index in its tub
+"""
+import os
+import json
+import time
+
+import numpy as np
+
+IMU_KEYS = ['imu/acl_x', 'imu/acl_y', 'imu/acl_z', 'imu/gyr_x', 'imu/gyr_y', 'imu/gyr_z']
+
+
+def build_dataset(cfg, tub_names, out_path, verbose=True):
+    '''
+    Compile the records of the tubs, a comma separated string or list of
+    paths like train.py takes, into a dataset at out_path. Records whose
+    image or angle and throttle can't be read are left out.
+    Returns the number of records written.
+    '''
+    from donkeycar.utils import gather_tubs, load_scaled_image_arr, get_record_index
+    from donkeycar.parts.datastore import load_json_record
+
+    tubs = gather_tubs(cfg, tub_names)
+    out_path = os.path.expanduser(out_path)
+    os.makedirs(out_path, exist_ok=True)
+
+    records = []
+    for i, tub in enumerate(tubs):
+        records += [(i, path) for path in tub.gather_records()]
+    n = len(records)
+    if verbose:
+        print('compiling %d records from %d tubs into %s' % (n, len(tubs), out_path))
+
+    images = np.lib.format.open_memmap(os.path.join(out_path, 'images.npy'), mode='w+', dtype=np.uint8,
+                                       shape=(n, cfg.IMAGE_H, cfg.IMAGE_W, cfg.IMAGE_DEPTH))
+    angle = np.zeros(n, dtype=np.float32)
+    throttle = np.zeros(n, dtype=np.float32)
+    imu = np.full((n, len(IMU_KEYS)), np.nan, dtype=np.float32)
+    behavior = None
+    milliseconds = np.zeros(n, dtype=np.int64)
+    tub_ids = np.zeros(n, dtype=np.int32)
+    index = np.zeros(n, dtype=np.int64)
+
+    start = time.time()
+    count = 0
+    for tub_id, record_path in records:
+        try:
+            json_data = load_json_record(record_path)
+            img_path = os.path.join(os.path.dirname(record_path), json_data['cam/image_array'])
+            img_arr = load_scaled_image_arr(img_path, cfg)
+            a = float(json_data['user/angle'])
+            t = float(json_data['user/throttle'])
+        except Exception:
+            img_arr = None
+        if img_arr is None:
+            continue
+
+        images[count] = img_arr.reshape(cfg.IMAGE_H, cfg.IMAGE_W, cfg.IMAGE_DEPTH)
+        angle[count] = a
+        throttle[count] = t
+        if all(k in json_data for k in IMU_KEYS):
+            imu[count] = [float(json_data[k]) for k in IMU_KEYS]
+        if 'behavior/one_hot_state_array' in json_data:
+            b = np.array(json_data['behavior/one_hot_state_array'], dtype=np.float32)
+            if behavior is None:
+                behavior = np.zeros((n, len(b)), dtype=np.float32)
+            behavior[count] = b
+        milliseconds[count] = json_data.get('milliseconds', 0)
+        tub_ids[count] = tub_id
+        index[count] = get_record_index(record_path)
+        count += 1
+
+        if verbose and count % 1000 == 0:
+            print('%d records, %.0f records/sec' % (count, count / (time.time() - start)))
+
+    images.flush()
+    del images
+
+    columns = {'angle': angle, 'throttle': throttle, 'imu': imu, 'milliseconds': milliseconds,
+               'tub': tub_ids, 'index': index}
+    if behavior is not None:
+        columns['behavior'] = behavior
+    for name, col in columns.items():
+        np.save(os.path.join(out_path, name + '.npy'), col[:count])
+
+    meta = {'count': count,
+            'image_shape': [cfg.IMAGE_H, cfg.IMAGE_W, cfg.IMAGE_DEPTH],
+            'columns': ['images'] + list(columns.keys()),
+            'tubs': [tub.path for tub in tubs],
+            'created': time.time()}
+    with open(os.path.join(out_path, 'dataset.json'), 'w') as f:
+        json.dump(meta, f)
+
+    if verbose:
+        print('wrote %d records, skipped %d, in %.1f sec' % (count, n - count, time.time() - start))
+    return count
+
+
+class Dataset:
+    '''
+    A dataset made by build_dataset, with its columns memory mapped.
+
+    >>> ds = Dataset('~/d2/datasets/week1')
+    >>> train_ix, val_ix = ds.split(0.8)
+    >>> for batch in ds.batch_gen(train_ix, 128):
+    ...     X, y = batch['images'], batch['angle']
+    '''
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        with open(os.path.join(self.path, 'dataset.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.count = self.meta['count']
+        self.columns = {}
+        for name in self.meta['columns']:
+            self.columns[name] = np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, name):
+        col = self.columns[name]
+        #images.npy is allocated for every record found, including skipped ones.
+        return col[:self.count]
+
+    def split(self, train_frac=0.8, seed=None):
+        '''
+        random train and validation record numbers.
+        '''
+        perm = np.random.RandomState(seed).permutation(self.count)
+        num_train = int(self.count * train_frac)
+        return np.sort(perm[:num_train]), np.sort(perm[num_train:])
+
+    def get_batch(self, rows, columns=None):
+        '''
+        the given rows of each column. rows are sorted first, so images are
+        read from the memory map in order.
+        '''
+        rows = np.sort(rows)
+        columns = columns or list(self.columns.keys())
+        return {name: np.asarray(self[name][rows]) for name in columns}
+
+    def batch_gen(self, rows, batch_size=128, columns=None, shuffle=True):
+        '''
+        endlessly yield batches of the given rows, a new order each epoch.
+        batches are cut down to the number of rows when there are fewer.
+        '''
+        rows = np.asarray(rows)
+        if len(rows) == 0:
+            raise ValueError('no rows to make batches of')
+        batch_size = min(batch_size, len(rows))
+        while True:
+            order = np.random.permutation(rows) if shuffle else rows
+            for i in range(0, len(order) - batch_size + 1, batch_size):
+                yield self.get_batch(order[i:i + batch_size], columns)
@@ -11,11 +11,18 @@ import time
 import json
 import datetime
 import random
+import re
 import glob
+import shutil
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from array import array
 import numpy as np
-import pandas as pd
 
-from PIL import Image
+#pandas and PIL are imported in the methods that use them, so the
+#drive loop and tub commands that don't need them start quickly.
 
 
 class OriginalWriter:
@@ -73,6 +80,7 @@ class OriginalWriter:
         Accepts values, pairs them with their inputs keys and saves them
         to disk.
         '''
+        from PIL import Image
         assert len(self.orig['inputs']) == len(args)
 
         t = time.time()
@@ -132,6 +140,556 @@ class OriginalWriter:
 
 
 
+#images in a chunked tub are referenced as <chunk>.img#<offset>:<length>
+CHUNK_IMAGE_REF = re.compile(r'^(.*\.img)#(\d+):(\d+)$')
+#and raw frames in a raw tub as <chunk>.raw#<offset>:<height>x<width>x<depth>
+RAW_FRAME_REF = re.compile(r'^(.*\.raw)#(\d+):(\d+(?:x\d+)*)$')
+
+
+def read_frame(path):
+    '''
+    read a raw uint8 frame from a chunk of a raw tub.
+    '''
+    m = RAW_FRAME_REF.match(path)
+    shape = tuple(int(d) for d in m.group(3).split('x'))
+    with open(m.group(1), 'rb') as f:
+        f.seek(int(m.group(2)))
+        data = f.read(int(np.prod(shape)))
+    return np.frombuffer(data, dtype=np.uint8).reshape(shape)
+
+
+def read_image_bytes(path):
+    '''
+    read the encoded bytes of an image, from its own file or from a chunk
+    of a chunked tub.
+    '''
+    m = CHUNK_IMAGE_REF.match(path)
+    if m is None:
+        with open(path, 'rb') as f:
+            return f.read()
+    chunk_path, offset, length = m.group(1), int(m.group(2)), int(m.group(3))
+    with open(chunk_path, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def open_image(path):
+    '''
+    open an image as a PIL image, from its own file or from a chunk of a
+    chunked tub.
+    '''
+    from PIL import Image
+    if RAW_FRAME_REF.match(path) is not None:
+        return Image.fromarray(read_frame(path))
+    if CHUNK_IMAGE_REF.match(path) is None:
+        return Image.open(path)
+    return Image.open(BytesIO(read_image_bytes(path)))
+
+
+class ChunkStore:
+    '''
+    Append only storage for a chunked tub. Records are appended as json
+    lines to chunk_N.jsonl and their images to chunk_N.img, starting a new
+    chunk every chunk_size records. Each chunk has a chunk_N.idx sidecar of
+    int64 (index, offset, length, image offset) entries, so a record can be
+    read without scanning, and the tail can be cut off by truncating.
+
+    With raw=True, images are stored as raw uint8 frames instead, in a
+    memory mapped chunk_N.raw that is allocated a chunk at a time, so
+    recording costs a copy instead of a jpeg encode and a write.
+    '''
+    ENTRY = 4
+
+    def __init__(self, path, chunk_size=1000, raw=False):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.raw = raw
+        self.frames = None
+        self.frames_offset = 0
+        #record index -> (chunk, offset, length, image offset). read from
+        #the sidecars the first time a record is looked up.
+        self.entries = None
+        self.files = None
+        self.files_chunk = None
+        self.pending_ix = None
+        self.pending_img_offset = 0
+
+    def chunk_path(self, chunk, ext):
+        return os.path.join(self.path, 'chunk_%05d%s' % (chunk, ext))
+
+    def chunks(self):
+        names = glob.glob(os.path.join(self.path, 'chunk_*.idx'))
+        return sorted(int(os.path.basename(n)[6:-4]) for n in names)
+
+    def load(self):
+        if self.entries is not None:
+            return
+        self.entries = {}
+        for chunk in self.chunks():
+            entries = self.read_index(chunk)
+            size = os.path.getsize(self.chunk_path(chunk, '.jsonl'))
+            for i in range(0, len(entries), self.ENTRY):
+                ix, offset, length, img_offset = entries[i:i + self.ENTRY]
+                #entries past the end of the data were lost in a crash.
+                if offset + length <= size:
+                    self.entries[ix] = (chunk, offset, length, img_offset)
+
+    def read_index(self, chunk):
+        entries = array('q')
+        with open(self.chunk_path(chunk, '.idx'), 'rb') as f:
+            data = f.read()
+        #ignore a partly written last entry.
+        whole = len(data) - len(data) % (self.ENTRY * entries.itemsize)
+        entries.frombytes(data[:whole])
+        return entries
+
+    def open_chunk(self, chunk):
+        if self.files_chunk == chunk:
+            return self.files
+        self.close()
+        exts = ('.jsonl', '.idx') if self.raw else ('.jsonl', '.img', '.idx')
+        self.files = {ext: open(self.chunk_path(chunk, ext), 'ab') for ext in exts}
+        self.files_chunk = chunk
+        if self.raw:
+            self.open_frames(chunk)
+        return self.files
+
+    def image_offset(self):
+        if self.raw:
+            return self.frames_offset
+        return self.files['.img'].tell()
+
+    def open_frames(self, chunk):
+        path = self.chunk_path(chunk, '.raw')
+        self.frames_offset = 0
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return
+        self.frames = np.memmap(path, dtype=np.uint8, mode='r+')
+        #continue after the frames of the last record in the chunk.
+        entries = self.read_index(chunk)
+        if len(entries) >= self.ENTRY:
+            _, offset, length, _ = entries[-self.ENTRY:]
+            with open(self.chunk_path(chunk, '.jsonl'), 'rb') as f:
+                f.seek(offset)
+                json_data = json.loads(f.read(length).decode('utf-8'))
+            for val in json_data.values():
+                m = RAW_FRAME_REF.match(val) if isinstance(val, str) else None
+                if m is not None:
+                    shape = [int(d) for d in m.group(3).split('x')]
+                    end = int(m.group(2)) + int(np.prod(shape))
+                    self.frames_offset = max(self.frames_offset, end)
+
+    def grow_frames(self, size):
+        path = self.chunk_path(self.files_chunk, '.raw')
+        if self.frames is not None:
+            self.frames.flush()
+            self.frames = None
+        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        try:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+        self.frames = np.memmap(path, dtype=np.uint8, mode='r+')
+
+    def append_frame(self, ix, arr):
+        '''
+        copy a uint8 frame for record ix into the chunk's raw frames,
+        before the record itself. returns the name to store in the record.
+        '''
+        self.open_chunk(ix // self.chunk_size)
+        if self.pending_ix != ix:
+            self.pending_ix = ix
+            self.pending_img_offset = self.frames_offset
+        arr = np.ascontiguousarray(arr, dtype=np.uint8)
+        offset = self.frames_offset
+        end = offset + arr.nbytes
+        if self.frames is None or end > len(self.frames):
+            size = 0 if self.frames is None else len(self.frames)
+            self.grow_frames(max(end, self.chunk_size * arr.nbytes, 2 * size))
+        self.frames[offset:end] = arr.reshape(-1)
+        self.frames_offset = end
+        shape = 'x'.join(str(d) for d in arr.shape)
+        return '%s#%d:%s' % (os.path.basename(self.chunk_path(self.files_chunk, '.raw')), offset, shape)
+
+    def append_image(self, ix, data):
+        '''
+        append encoded image bytes for record ix, before the record itself.
+        returns the name to store in the record.
+        '''
+        files = self.open_chunk(ix // self.chunk_size)
+        f = files['.img']
+        if self.pending_ix != ix:
+            self.pending_ix = ix
+            self.pending_img_offset = f.tell()
+        offset = f.tell()
+        f.write(data)
+        f.flush()
+        return '%s#%d:%d' % (os.path.basename(f.name), offset, len(data))
+
+    def append(self, ix, json_data):
+        chunk = ix // self.chunk_size
+        files = self.open_chunk(chunk)
+        img_offset = self.pending_img_offset if self.pending_ix == ix else self.image_offset()
+        self.pending_ix = None
+
+        line = (json.dumps(json_data) + '\n').encode('utf-8')
+        f = files['.jsonl']
+        offset = f.tell()
+        f.write(line)
+        f.flush()
+        files['.idx'].write(array('q', [ix, offset, len(line), img_offset]).tobytes())
+        files['.idx'].flush()
+        if self.entries is not None:
+            self.entries[ix] = (chunk, offset, len(line), img_offset)
+
+    def read(self, ix):
+        self.load()
+        chunk, offset, length, _ = self.entries[ix]
+        with open(self.chunk_path(chunk, '.jsonl'), 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.read(length).decode('utf-8'))
+
+    def read_many(self, ixs):
+        '''
+        the records of ixs, in order, opening each chunk file once.
+        '''
+        self.load()
+        records = [None] * len(ixs)
+        reads = {}
+        for i, ix in enumerate(ixs):
+            chunk, offset, length, _ = self.entries[ix]
+            reads.setdefault(chunk, []).append((i, offset, length))
+        for chunk, chunk_reads in reads.items():
+            with open(self.chunk_path(chunk, '.jsonl'), 'rb') as f:
+                for i, offset, length in sorted(chunk_reads, key=lambda r: r[1]):
+                    f.seek(offset)
+                    records[i] = json.loads(f.read(length).decode('utf-8'))
+        return records
+
+    def stats(self, chunk):
+        '''
+        the min and max of each field over the records of a chunk, or None
+        for fields that can't be ordered. kept in chunk_N.stats.json and
+        worked out again when the chunk has changed.
+        '''
+        stats_path = self.chunk_path(chunk, '.stats.json')
+        jsonl_stat = file_stat(self.chunk_path(chunk, '.jsonl'))
+        try:
+            with open(stats_path, 'r') as f:
+                stats = json.load(f)
+            if stats['file'] == jsonl_stat:
+                return stats['fields']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        fields = {}
+        with open(self.chunk_path(chunk, '.jsonl'), 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                for key, val in record.items():
+                    fields[key] = widen_range(fields.get(key, [None, None]), val)
+        fields = {k: (None if v is False else v) for k, v in fields.items()}
+
+        try:
+            with open(stats_path + '.tmp', 'w') as f:
+                json.dump({'file': jsonl_stat, 'fields': fields}, f)
+            os.replace(stats_path + '.tmp', stats_path)
+        except OSError:
+            pass
+        return fields
+
+    def indexes(self):
+        self.load()
+        return list(self.entries.keys())
+
+    def truncate(self, first_ix):
+        '''
+        remove record first_ix and every record after it.
+        '''
+        self.load()
+        self.close()
+        removed = sorted((e for ix, e in self.entries.items() if ix >= first_ix))
+        self.entries = {ix: e for ix, e in self.entries.items() if ix < first_ix}
+        if not removed:
+            return
+
+        chunk, offset, _, img_offset = removed[0]
+        kept = sum(1 for e in self.entries.values() if e[0] == chunk)
+        for later in self.chunks():
+            if later > chunk:
+                for ext in ('.jsonl', '.img', '.idx', '.raw', '.stats.json'):
+                    if os.path.exists(self.chunk_path(later, ext)):
+                        os.unlink(self.chunk_path(later, ext))
+
+        #raw frames stay allocated, later ones are written over them.
+        sizes = [('.jsonl', offset), ('.idx', kept * self.ENTRY * 8)]
+        if not self.raw:
+            sizes.append(('.img', img_offset))
+        for ext, size in sizes:
+            with open(self.chunk_path(chunk, ext), 'r+b') as f:
+                f.truncate(size)
+
+    def close(self):
+        if self.files is not None:
+            for f in self.files.values():
+                f.close()
+        if self.frames is not None:
+            self.frames.flush()
+        self.files = None
+        self.files_chunk = None
+        self.frames = None
+
+
+class TubManifest:
+    '''
+    A list of the records in a tub, kept in manifest.jsonl so a tub can be
+    opened without listing or reading its record files. Each line is a
+    record, {"ix": 5, "ms": 250, "images": {"cam/image_array": name}}, or an
+    event: {"remove": [first, last]} drops records first to last, or all
+    from first when last is null, {"erase": [first, last]} is a tombstone
+    for records first to last, which drops them even if they are added
+    after it, and {"exclude": [...]} sets the excluded records. Lines are
+    only ever appended.
+    '''
+    def __init__(self, path):
+        self.path = os.path.join(path, 'manifest.jsonl')
+        #record index -> (milliseconds, images). read on first use.
+        self.records = None
+        self.exclude = set()
+        self.erased = set()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def create(self):
+        open(self.path, 'a').close()
+        self.records = {}
+
+    def load(self):
+        if self.records is not None:
+            return
+        self.records = {}
+        self.erased = set()
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    self.apply(json.loads(line))
+                except ValueError:
+                    #a partly written last line.
+                    pass
+
+    def apply(self, entry):
+        if 'ix' in entry:
+            if entry['ix'] not in self.erased:
+                self.records[entry['ix']] = (entry.get('ms'), entry.get('images', {}))
+        elif 'erase' in entry:
+            first, last = entry['erase']
+            for ix in range(first, last + 1):
+                self.erased.add(ix)
+                self.records.pop(ix, None)
+        elif 'remove' in entry:
+            first, last = entry['remove']
+            for ix in [ix for ix in self.records if ix >= first and (last is None or ix <= last)]:
+                del self.records[ix]
+        elif 'exclude' in entry:
+            self.exclude = set(entry['exclude'])
+
+    def append(self, entry):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        if self.records is not None:
+            self.apply(entry)
+
+    def add(self, ix, ms, images):
+        self.append({'ix': ix, 'ms': ms, 'images': images})
+
+    def remove(self, first, last=None):
+        self.append({'remove': [first, last]})
+
+    def erase(self, first, last):
+        self.append({'erase': [first, last]})
+
+    def has(self, ix):
+        self.load()
+        return ix in self.records
+
+    def set_exclude(self, exclude):
+        self.append({'exclude': sorted(exclude)})
+
+    def last_ix(self):
+        '''
+        the last record index, erased or not, read from the end of the
+        manifest when it's a record or an erase, so opening a tub doesn't
+        read the whole manifest.
+        '''
+        if self.records is None:
+            with open(self.path, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                f.seek(max(f.tell() - 4096, 0))
+                lines = f.read().splitlines()
+            try:
+                entry = json.loads(lines[-1].decode('utf-8'))
+                if 'ix' in entry:
+                    return entry['ix']
+                if 'erase' in entry:
+                    return entry['erase'][1]
+            except (IndexError, ValueError):
+                pass
+            self.load()
+        return max(list(self.records) + list(self.erased))
+
+    def indexes(self):
+        self.load()
+        return list(self.records.keys())
+
+    def count(self):
+        self.load()
+        return len(self.records)
+
+
+def file_stat(path):
+    '''
+    [size, modified time in ns] of a file, or None when it can't be read.
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def files_unchanged(tub_path, files):
+    '''
+    whether the files from Tub.record_files still have the same stats.
+    '''
+    if not files:
+        return False
+    return all(stat is not None and file_stat(os.path.join(tub_path, name)) == stat
+               for name, stat in files.items())
+
+
+def check_records(tub_path, ixs):
+    '''
+    read records of a tub, decoding their images. returns the files of the
+    good records, by index, and the indexes of the bad ones. module level,
+    so it can run in tubcheck's worker processes.
+    '''
+    tub = Tub(tub_path)
+    good = {}
+    bad = []
+    for ix in ixs:
+        try:
+            json_data = tub.get_raw_json_record(ix)
+            files = tub.record_files(ix, json_data)
+            tub.read_record(tub.make_record_paths_absolute(json_data))
+            good[ix] = files
+        except Exception:
+            bad.append(ix)
+    tub.shutdown()
+    return good, bad
+
+
+QUERY_OPS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    'in': lambda a, b: a in b,
+}
+
+
+def widen_range(bounds, val):
+    '''
+    [min, max] widened to include val. False once the field has values
+    that can't be ordered together, like lists or a mix of strings and
+    numbers. nulls are left out, as they never match a condition.
+    '''
+    if bounds is False or val is None:
+        return bounds
+    if isinstance(val, float) and val != val:
+        return bounds
+    if not isinstance(val, (int, float, str)):
+        return False
+    lo, hi = bounds
+    if lo is None:
+        return [val, val]
+    if isinstance(val, str) != isinstance(lo, str):
+        return False
+    return [min(lo, val), max(hi, val)]
+
+
+def record_matches(record, where):
+    '''
+    whether a record meets every (key, op, value) condition in where.
+    '''
+    for key, op, val in where:
+        if key not in record:
+            return False
+        try:
+            if not QUERY_OPS[op](record[key], val):
+                return False
+        except TypeError:
+            return False
+    return True
+
+
+def range_may_match(fields, where):
+    '''
+    whether records with the field ranges from ChunkStore.stats could meet
+    every condition in where. False only when none of them can.
+    '''
+    for key, op, val in where:
+        if key not in fields:
+            return False
+        bounds = fields[key]
+        if bounds is None:
+            continue
+        lo, hi = bounds
+        try:
+            if op == '==' and (val < lo or val > hi):
+                return False
+            if op == '!=' and lo == hi == val:
+                return False
+            if op == '<' and not lo < val:
+                return False
+            if op == '<=' and not lo <= val:
+                return False
+            if op == '>' and not hi > val:
+                return False
+            if op == '>=' and not hi >= val:
+                return False
+            if op == 'in' and not any(lo <= v <= hi for v in val):
+                return False
+        except TypeError:
+            continue
+    return True
+
+
+def epoch_batches(n, batch_size, shuffle=True):
+    '''
+    endlessly yield arrays of batch_size row numbers out of n rows. every
+    row is used once per epoch, in a new random order each epoch when
+    shuffling, and batches carry on across epochs.
+    '''
+    if n == 0:
+        raise Exception('no records to make batches of')
+    order = np.empty(0, dtype=np.int64)
+    while True:
+        while len(order) < batch_size:
+            epoch = np.random.permutation(n) if shuffle else np.arange(n)
+            order = np.concatenate([order, epoch])
+        yield order[:batch_size]
+        order = order[batch_size:]
+
+
 class Tub(object):
     """
     A datastore to store sensor data in a key, value format.
@@ -146,15 +704,23 @@ class Tub(object):
     >>> types = ['float', 'image']
     >>> t=Tub(path=path, inputs=inputs, types=types)
 
+    New tubs store one json file and one image file per record, unless
+    tub_format='chunked', which appends them to a few large chunk files
+    instead, or tub_format='raw', which is chunked but keeps images as raw
+    frames to be encoded later with `donkey tubencode`. The format of an
+    existing tub is read from its meta.json.
+
     """
 
-    def __init__(self, path, inputs=None, types=None, user_meta=[]):
+    def __init__(self, path, inputs=None, types=None, user_meta=[], tub_format=None, chunk_size=1000):
 
         self.path = os.path.expanduser(path)
         #print('path_in_tub:', self.path)
         self.meta_path = os.path.join(self.path, 'meta.json')
         self.exclude_path = os.path.join(self.path, "exclude.json")
         self.df = None
+        self.chunks = None
+        self.manifest = TubManifest(self.path)
 
         exists = os.path.exists(self.path)
 
@@ -174,6 +740,15 @@ class Tub(object):
             except FileNotFoundError:
                 self.exclude = set()
 
+            if self.meta.get('format') in ('chunked', 'raw'):
+                self.chunks = ChunkStore(self.path, self.meta.get('chunk_size', chunk_size),
+                                         raw=self.meta['format'] == 'raw')
+
+            if not self.manifest.exists():
+                #older tub. records are found by scanning until the
+                #manifest is rebuilt with `donkey tubmanifest`.
+                self.manifest = None
+
             try:
                 self.current_ix = self.get_last_ix() + 1
             except ValueError:
@@ -186,18 +761,24 @@ class Tub(object):
                 self.meta['start'] = self.start_time
 
         elif not exists and inputs:
+            if tub_format not in (None, 'files', 'chunked', 'raw'):
+                raise ValueError('unknown tub format: {}'.format(tub_format))
             print('Tub does NOT exist. Creating new tub...')
             self.start_time = time.time()
             #create log and save meta
             os.makedirs(self.path)
             self.meta = {'inputs': inputs, 'types': types, 'start': self.start_time}
+            if tub_format in ('chunked', 'raw'):
+                self.meta['format'] = tub_format
+                self.meta['chunk_size'] = chunk_size
+                self.chunks = ChunkStore(self.path, chunk_size, raw=tub_format == 'raw')
             for kv in user_meta:
                 kvs = kv.split(":")
                 if len(kvs) == 2:
                     self.meta[kvs[0]] = kvs[1]
                 # else exception? print message?
-            with open(self.meta_path, 'w') as f:
-                json.dump(self.meta, f)
+            self.write_meta()
+            self.manifest.create()
             self.current_ix = 0
             self.exclude = set()
             print('New tub created at: {}'.format(self.path))
@@ -208,13 +789,43 @@ class Tub(object):
             raise AttributeError(msg)
 
 
+    def write_meta(self):
+        #write it whole and then swap it in, so meta.json is never half written.
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, self.meta_path)
+
     def get_last_ix(self):
+        if self.manifest is not None:
+            return self.manifest.last_ix()
         index = self.get_index()           
         return max(index)
 
-    def update_df(self):
-        df = pd.DataFrame([self.get_json_record(i) for i in self.get_index(shuffled=False)])
-        self.df = df
+    def update_df(self, workers=8):
+        '''
+        load every record into self.df, a column per record key. file names
+        are made absolute like get_json_record does.
+        '''
+        import pandas as pd
+        records = self.get_raw_json_records(self.get_index(shuffled=False), workers)
+
+        #build the columns directly, pandas is much slower at it from dicts.
+        #keys a record doesn't have are left None, like pandas does.
+        columns = {}
+        for n, record in enumerate(records):
+            for key, val in record.items():
+                col = columns.get(key)
+                if col is None:
+                    col = columns[key] = [None] * len(records)
+                col[n] = val
+
+        #make file names absolute a column at a time.
+        for key, col in columns.items():
+            if any(type(v) == str for v in col):
+                columns[key] = [os.path.join(self.path, v) if type(v) == str and '.' in v else v for v in col]
+
+        self.df = pd.DataFrame(columns)
 
     def get_df(self):
         if self.df is None:
@@ -223,9 +834,29 @@ class Tub(object):
 
 
     def get_index(self, shuffled=True):
+        if self.manifest is not None:
+            nums = self.manifest.indexes()
+        else:
+            nums = self.scan_index()
+        
+        if shuffled:
+            random.shuffle(nums)
+        else:
+            nums = sorted(nums)
+            
+        return nums 
+
+
+    def scan_index(self):
+        '''
+        find the records in the tub's files, without the manifest.
+        '''
+        if self.chunks is not None:
+            return self.chunks.indexes()
+
         files = next(os.walk(self.path))[2]
         record_files = [f for f in files if f[:6]=='record']
-        
+
         def get_file_ix(file_name):
             try:
                 name = file_name.split('.')[0]
@@ -234,15 +865,39 @@ class Tub(object):
                 num = 0
             return num
 
-        nums = [get_file_ix(f) for f in record_files]
-        
-        if shuffled:
-            random.shuffle(nums)
-        else:
-            nums = sorted(nums)
-            
-        return nums 
+        return [get_file_ix(f) for f in record_files]
 
+    def rebuild_manifest(self):
+        '''
+        write a new manifest from the records in the tub's files.
+        '''
+        image_keys = [k for k, t in zip(self.inputs, self.types) if t in ('image', 'image_array')]
+        manifest = TubManifest(self.path)
+        #erased records are still on disk until compaction, keep them erased.
+        erased = set()
+        if manifest.exists():
+            manifest.load()
+            erased = manifest.erased
+        tmp_path = manifest.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for ix in sorted(self.scan_index()):
+                if ix in erased:
+                    f.write(json.dumps({'erase': [ix, ix]}) + '\n')
+                    continue
+                try:
+                    json_data = self.get_raw_json_record(ix)
+                except (OSError, ValueError):
+                    print('skipping unreadable record:', self.path, ix)
+                    continue
+                images = {k: json_data[k] for k in image_keys if k in json_data}
+                entry = {'ix': ix, 'ms': json_data.get('milliseconds'), 'images': images}
+                f.write(json.dumps(entry) + '\n')
+            if self.exclude:
+                f.write(json.dumps({'exclude': sorted(self.exclude)}) + '\n')
+        os.replace(tmp_path, manifest.path)
+        manifest.records = None
+        self.manifest = manifest
+        return manifest
 
     @property
     def inputs(self):
@@ -257,6 +912,10 @@ class Tub(object):
         return input_types.get(key)
 
     def write_json_record(self, json_data):
+        if self.chunks is not None:
+            self.chunks.append(self.current_ix, json_data)
+            return
+
         path = self.get_json_record_path(self.current_ix)
         try:
             with open(path, 'w') as fp:
@@ -271,6 +930,10 @@ class Tub(object):
             raise
 
     def get_num_records(self):
+        if self.manifest is not None:
+            return self.manifest.count()
+        if self.chunks is not None:
+            return len(self.chunks.indexes())
         import glob
         files = glob.glob(os.path.join(self.path, 'record_*.json'))
         return len(files)
@@ -292,40 +955,107 @@ class Tub(object):
 
 
 
-    def check(self, fix=False):
+    def check(self, fix=False, pool=None, use_cache=True):
         '''
         Iterate over all records and make sure we can load them.
         Optionally remove records that cause a problem.
+        Records that passed a check before are skipped while the files they
+        are stored in keep their size and modified time, as kept in
+        check_cache.json. Given a concurrent.futures pool, records are
+        checked in parallel. Returns the records with problems. Excluded
+        records aren't checked, like records fixed in chunked tubs.
         '''
         print('Checking tub:%s.' % self.path)
         print('Found: %d records.' % self.get_num_records())
-        problems = False
-        for ix in self.get_index(shuffled=False):
-            try:
-                self.get_record(ix)
-            except:
-                problems = True
-                if fix == False:
-                    print('problems with record:', self.path, ix)
-                else:
-                    print('problems with record, removing:', self.path, ix)
-                    self.remove_record(ix)
+        start = time.time()
+        cache = self.load_check_cache() if use_cache else {}
+        index = [ix for ix in self.get_index(shuffled=False) if ix not in self.exclude]
+        todo = [ix for ix in index if not files_unchanged(self.path, cache.get(ix))]
+
+        if pool is None:
+            results = [check_records(self.path, todo)]
+        else:
+            slices = [todo[i:i + 500] for i in range(0, len(todo), 500)]
+            results = pool.map(check_records, [self.path] * len(slices), slices)
+
+        problems = []
+        for good, bad in results:
+            cache.update(good)
+            problems += bad
+
+        for ix in sorted(problems):
+            cache.pop(ix, None)
+            if fix == False:
+                print('problems with record:', self.path, ix)
+            else:
+                print('problems with record, removing:', self.path, ix)
+                self.remove_record(ix)
+
+        if use_cache:
+            index = set(index)
+            self.write_check_cache({ix: files for ix, files in cache.items() if ix in index})
+
+        elapsed = time.time() - start
+        print('Checked %d records, skipped %d unchanged, in %.1f sec (%.0f records/sec).' %
+              (len(todo), len(index) - len(todo), elapsed, len(todo) / max(elapsed, 1e-6)))
         if not problems:
             print("No problems found.")
+        return problems
+
+    @property
+    def check_cache_path(self):
+        return os.path.join(self.path, 'check_cache.json')
+
+    def load_check_cache(self):
+        try:
+            with open(self.check_cache_path, 'r') as f:
+                return {int(ix): files for ix, files in json.load(f).items()}
+        except (OSError, ValueError):
+            return {}
+
+    def write_check_cache(self, cache):
+        tmp_path = self.check_cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, self.check_cache_path)
+
+    def record_files(self, ix, json_data):
+        '''
+        the names of the files a record and its images are stored in, with
+        their size and modified time.
+        '''
+        if self.chunks is not None:
+            self.chunks.load()
+            names = [os.path.basename(self.chunks.chunk_path(self.chunks.entries[ix][0], '.jsonl'))]
+        else:
+            names = [os.path.basename(self.get_json_record_path(ix))]
+        for key, val in json_data.items():
+            if self.get_input_type(key) in ('image', 'image_array') and val:
+                names.append(val.split('#')[0])
+        return {name: file_stat(os.path.join(self.path, name)) for name in names}
 
     def remove_record(self, ix):
         '''
-        remove data associate with a record
+        remove data associate with a record, its json and image files.
         '''
-        record = self.get_json_record_path(ix)
-        os.unlink(record)
+        if self.chunks is not None:
+            #records in the middle of a chunk can't be removed, only excluded.
+            self.exclude_index(ix)
+            self.write_exclude()
+            return
 
-    def put_record(self, data):
+        self.delete_record_files(ix)
+        if self.manifest is not None:
+            self.manifest.remove(ix, ix)
+
+    def put_record(self, data, timestamp=None):
         """
         Save values like images that can't be saved in the csv log and
         return a record with references to the saved values that can
-        be saved in a csv.
+        be saved in a csv. timestamp is when the values were recorded,
+        from time.time(), if not now.
         """
+        from PIL import Image
         json_data = {}
         self.current_ix += 1
         
@@ -339,11 +1069,25 @@ class Tub(object):
             elif typ in ['str', 'float', 'int', 'boolean', 'vector']:
                 json_data[key] = val
 
+            elif typ in ('image', 'image_array') and self.chunks is not None and self.chunks.raw:
+                json_data[key] = self.chunks.append_frame(self.current_ix, np.asarray(val))
+
+            elif typ == 'image' and self.chunks is not None:
+                f = BytesIO()
+                val.save(f, format='png')
+                json_data[key] = self.chunks.append_image(self.current_ix, f.getvalue())
+
             elif typ is 'image':
                 path = self.make_file_path(key)
                 val.save(path)
                 json_data[key]=path
 
+            elif typ == 'image_array' and self.chunks is not None:
+                img = Image.fromarray(np.uint8(val))
+                f = BytesIO()
+                img.save(f, format='jpeg')
+                json_data[key] = self.chunks.append_image(self.current_ix, f.getvalue())
+
             elif typ == 'image_array':
                 img = Image.fromarray(np.uint8(val))
                 name = self.make_file_name(key, ext='.jpg')
@@ -354,39 +1098,73 @@ class Tub(object):
                 msg = 'Tub does not know what to do with this type {}'.format(typ)
                 raise TypeError(msg)
 
-        json_data['milliseconds'] = int((time.time() - self.start_time) * 1000)
+        if timestamp is None:
+            timestamp = time.time()
+        json_data['milliseconds'] = int((timestamp - self.start_time) * 1000)
 
         self.write_json_record(json_data)
+        if self.manifest is not None:
+            images = {k: v for k, v in json_data.items() if self.get_input_type(k) in ('image', 'image_array')}
+            self.manifest.add(self.current_ix, json_data['milliseconds'], images)
         return self.current_ix
 
     def erase_last_n_records(self, num_erase):
         '''
-        erase N records from the disc and move current back accordingly
+        erase the last N records. With a manifest this only appends a
+        tombstone to it, however many records are erased, and record numbers
+        aren't reused. The files stay on disk until `donkey tubcompact`.
+        Older tubs without a manifest have the files deleted, and current
+        moved back accordingly.
         '''
-        last_erase = self.current_ix
-        first_erase = last_erase - num_erase
-        self.current_ix = first_erase - 1
-        if self.current_ix < 0:
-            self.current_ix = 0
+        self.erase_records(self.current_ix - num_erase + 1, self.current_ix)
 
-        for i in range(first_erase, last_erase):
-            if i < 0:
-                continue
+    def erase_records(self, first_erase, last_erase):
+        first_erase = max(first_erase, 0)
+        if last_erase < first_erase:
+            return
+
+        if self.manifest is not None:
+            self.manifest.erase(first_erase, last_erase)
+            return
+
+        self.current_ix = max(first_erase - 1, 0)
+        if self.chunks is not None:
+            #the erased records are the last ones appended, so cut them off.
+            self.chunks.truncate(first_erase)
+            return
+
+        for i in range(first_erase, last_erase + 1):
             self.erase_record(i)
 
     def erase_record(self, i):
+        if self.chunks is not None:
+            self.remove_record(i)
+            return
+        self.delete_record_files(i)
+
+    def delete_record_files(self, i):
         json_path = self.get_json_record_path(i)
+        try:
+            json_data = self.get_raw_json_record(i)
+        except (OSError, ValueError):
+            json_data = {}
+        for key, val in json_data.items():
+            if self.get_input_type(key) in ('image', 'image_array') and val:
+                img_path = os.path.join(self.path, val)
+                if os.path.exists(img_path):
+                    os.unlink(img_path)
         if os.path.exists(json_path):
             os.unlink(json_path)
-        img_filename = '%d_cam-image_array_.jpg' % (i)
-        img_path = os.path.join(self.path, img_filename)
-        if os.path.exists(img_path):
-            os.unlink(img_path)
 
     def get_json_record_path(self, ix):
         return os.path.join(self.path, 'record_'+str(ix)+'.json')
 
     def get_json_record(self, ix):
+        if self.manifest is not None and not self.manifest.has(ix):
+            raise FileNotFoundError('no record %d in tub %s' % (ix, self.path))
+        if self.chunks is not None:
+            return self.make_record_paths_absolute(self.get_raw_json_record(ix))
+
         path = self.get_json_record_path(ix)
         try:
             with open(path, 'r') as fp:
@@ -403,6 +1181,97 @@ class Tub(object):
         return record_dict
 
 
+    def get_raw_json_record(self, ix):
+        '''
+        the record as it's stored, with file names relative to the tub.
+        '''
+        if self.manifest is not None and not self.manifest.has(ix):
+            raise FileNotFoundError('no record %d in tub %s' % (ix, self.path))
+        if self.chunks is not None:
+            try:
+                return self.chunks.read(ix)
+            except KeyError:
+                raise FileNotFoundError('no record %d in tub %s' % (ix, self.path))
+        with open(self.get_json_record_path(ix), 'r') as fp:
+            return json.load(fp)
+
+    def time_index(self):
+        '''
+        arrays of the milliseconds and indexes of the tub's records, sorted
+        by time. read from the manifest, or the records of older tubs.
+        '''
+        if self.manifest is not None:
+            self.manifest.load()
+            items = [(ms, ix) for ix, (ms, _) in self.manifest.records.items() if ms is not None]
+        else:
+            index = self.get_index(shuffled=False)
+            records = self.get_raw_json_records(index)
+            items = [(r['milliseconds'], ix) for ix, r in zip(index, records) if r.get('milliseconds') is not None]
+        items.sort()
+        ms = np.array([m for m, _ in items], dtype=np.int64)
+        ixs = np.array([ix for _, ix in items], dtype=np.int64)
+        return ms, ixs
+
+    def query(self, start=None, end=None, where=None, include_excluded=False):
+        '''
+        the indexes of the records, in time order, recorded from start up to
+        end milliseconds after the tub started, that meet every (key, op,
+        value) condition in where. ops are ==, !=, <, <=, >, >= and in.
+
+        >>> tub.query(60000, 120000, where=[('user/mode', '==', 'user'), ('user/throttle', '>', 0.1)])
+
+        The time range is looked up in the sorted timestamps. Chunked tubs
+        skip the chunks whose min and max values rule out a condition, and
+        only read the records of the others.
+        '''
+        ms, ixs = self.time_index()
+        first = 0 if start is None else np.searchsorted(ms, start, 'left')
+        last = len(ms) if end is None else np.searchsorted(ms, end, 'left')
+        index = [int(ix) for ix in ixs[first:last]]
+        if not include_excluded:
+            index = [ix for ix in index if ix not in self.exclude]
+        if not where:
+            return index
+
+        matches = set()
+        if self.chunks is not None:
+            self.chunks.load()
+            by_chunk = {}
+            for ix in index:
+                if ix in self.chunks.entries:
+                    by_chunk.setdefault(self.chunks.entries[ix][0], []).append(ix)
+            for chunk, chunk_index in by_chunk.items():
+                if not range_may_match(self.chunks.stats(chunk), where):
+                    continue
+                records = self.chunks.read_many(chunk_index)
+                matches.update(ix for ix, r in zip(chunk_index, records) if record_matches(r, where))
+        else:
+            records = self.get_raw_json_records(index)
+            matches.update(ix for ix, r in zip(index, records) if record_matches(r, where))
+        return [ix for ix in index if ix in matches]
+
+    def get_raw_json_records(self, index, workers=8):
+        '''
+        the stored records of index, in order. chunked tubs read each chunk
+        once. record files are read by a pool of threads, as the time goes
+        into waiting on opening and reading many small files.
+        '''
+        if self.chunks is not None:
+            try:
+                return self.chunks.read_many(index)
+            except KeyError as e:
+                raise FileNotFoundError('no record %s in tub %s' % (e, self.path))
+
+        def read_slice(ixs):
+            return [self.get_raw_json_record(ix) for ix in ixs]
+
+        workers = max(1, min(workers, len(index) // 100))
+        step = (len(index) + workers - 1) // workers or 1
+        slices = [index[i:i + step] for i in range(0, len(index), step)]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(read_slice, slices))
+        return [record for result in results for record in result]
+
     def get_record(self, ix):
 
         json_data = self.get_json_record(ix)
@@ -418,7 +1287,7 @@ class Tub(object):
 
             #load objects that were saved as separate files
             if typ == 'image_array':
-                img = Image.open((val))
+                img = open_image(val)
                 val = np.array(img)
 
             data[key] = val
@@ -428,6 +1297,13 @@ class Tub(object):
 
 
     def gather_records(self):
+        if self.chunks is not None or self.manifest is not None:
+            #list them from the index. chunked records have no file of their
+            #own, their paths are named like record files so they can be
+            #read with load_json_record.
+            index = [ix for ix in self.get_index(shuffled=False) if ix not in self.exclude]
+            return [self.get_json_record_path(ix) for ix in index]
+
         ri = lambda fnm : int( os.path.basename(fnm).split('_')[1].split('.')[0] )
 
         record_paths = glob.glob(os.path.join(self.path, 'record_*.json'))
@@ -444,10 +1320,12 @@ class Tub(object):
     def delete(self):
         """ Delete the folder and files for this tub. """
         import shutil
+        self.shutdown()
         shutil.rmtree(self.path)
 
     def shutdown(self):
-        pass
+        if self.chunks is not None:
+            self.chunks.close()
 
 
     def excluded(self, index):
@@ -470,46 +1348,69 @@ class Tub(object):
         else:
             with open(self.exclude_path,'w') as f:
                 json.dump( list(self.exclude), f )
+        if self.manifest is not None:
+            self.manifest.set_exclude(self.exclude)
 
     def get_record_gen(self, record_transform=None, shuffle=True, df=None):
-
+        '''
+        endlessly yield the records of df, in a new random order each epoch
+        when shuffling.
+        '''
         if df is None:
             df = self.get_df()
 
+        records = df.to_dict(orient='records')
+        for rows in epoch_batches(len(records), 1, shuffle):
+            record_dict = dict(records[rows[0]])
 
-        while True:
-            for row in self.df.iterrows():
-                if shuffle:
-                    record_dict = df.sample(n=1).to_dict(orient='record')[0]
-
-                if record_transform:
-                    record_dict = record_transform(record_dict)
-
-                record_dict = self.read_record(record_dict)
+            if record_transform:
+                record_dict = record_transform(record_dict)
 
-                yield record_dict
+            yield self.read_record(record_dict)
 
 
     def get_batch_gen(self, keys, record_transform=None, batch_size=128, shuffle=True, df=None):
-
-        record_gen = self.get_record_gen(record_transform, shuffle=shuffle, df=df)
+        '''
+        endlessly yield dicts of arrays of batch_size records. columns are
+        sliced for the whole batch and only the batch's images are loaded.
+        record_transform works on single records, so with one the batch's
+        records are made into dicts first.
+        '''
+        if df is None:
+            df = self.get_df()
 
         if keys == None:
-            keys = list(self.df.columns)
+            keys = list(df.columns)
 
-        while True:
-            record_list = []
-            for _ in range(batch_size):
-                record_list.append(next(record_gen))
+        image_keys = [k for k in keys if self.get_input_type(k) == 'image_array']
+        if record_transform:
+            records = df.to_dict(orient='records')
+        else:
+            columns = {k: df[k].values for k in keys}
+
+        for rows in epoch_batches(len(df), batch_size, shuffle):
+            if record_transform:
+                record_list = [record_transform(dict(records[r])) for r in rows]
+                batch = {k: [r[k] for r in record_list] for k in keys}
+            else:
+                batch = {k: columns[k][rows] for k in keys}
 
-            batch_arrays = {}
-            for i, k in enumerate(keys):
-                arr = np.array([r[k] for r in record_list])
-                # if len(arr.shape) == 1:
-                #    arr = arr.reshape(arr.shape + (1,))
-                batch_arrays[k] = arr
+            yield self.stack_batch(batch, keys, image_keys)
 
-            yield batch_arrays
+    def stack_batch(self, batch, keys, image_keys):
+        '''
+        make the columns of a batch into arrays, loading its images.
+        '''
+        batch_arrays = {}
+        for k in keys:
+            arr = batch[k]
+            if k in image_keys:
+                arr = np.array([np.array(open_image(path)) for path in arr])
+            elif not isinstance(arr, np.ndarray) or arr.dtype == object:
+                #lists, like one hot arrays, stack into a 2d array
+                arr = np.array(list(arr))
+            batch_arrays[k] = arr
+        return batch_arrays
 
 
     def get_train_gen(self, X_keys, Y_keys, batch_size=128, record_transform=None, df=None):
@@ -541,8 +1442,41 @@ class Tub(object):
 
 
 class TubWriter(Tub):
-    def __init__(self, *args, **kwargs):
+    '''
+    A part that writes its inputs to the tub on every run.
+
+    queue_size : when more than 0, run only copies the record into a queue
+        and a background thread encodes and writes it, so the drive loop
+        doesn't wait on jpeg encoding and the sd card. Arrays are copied
+        into reused buffers, so the camera can keep reusing its own.
+    queue_policy : what run does when the queue is full. 'block' waits for
+        the writer, 'drop_newest' drops the record being added and
+        'drop_oldest' drops the oldest queued record to make room.
+    '''
+    QUEUE_POLICIES = ('block', 'drop_newest', 'drop_oldest')
+
+    def __init__(self, *args, queue_size=0, queue_policy='block', **kwargs):
         super(TubWriter, self).__init__(*args, **kwargs)
+        if queue_policy not in self.QUEUE_POLICIES:
+            raise ValueError('unknown queue policy: {}'.format(queue_policy))
+        self.queue_size = queue_size
+        self.queue_policy = queue_policy
+        self.queue = deque()
+        self.queue_changed = threading.Condition()
+        #free array buffers by (shape, dtype).
+        self.buffers = {}
+        self.enqueued = 0
+        self.dropped = 0
+        self.errors = 0
+        self.max_depth = 0
+        self.writing = False
+        #the record being written by the writer thread.
+        self.writing_ix = None
+        self.running = queue_size > 0
+        self.thread = None
+        if self.running:
+            self.thread = threading.Thread(target=self.write_queued, daemon=True)
+            self.thread.start()
 
     def run(self, *args):
         '''
@@ -554,9 +1488,109 @@ class TubWriter(Tub):
         assert len(self.inputs) == len(args)
 
         self.record_time = int(time.time() - self.start_time)
-        record = dict(zip(self.inputs, args))
-        self.put_record(record)
-        return self.current_ix
+        if not self.running:
+            record = dict(zip(self.inputs, args))
+            self.put_record(record)
+            return self.current_ix
+
+        record = dict(zip(self.inputs, [self.copy_value(v) for v in args]))
+        with self.queue_changed:
+            if len(self.queue) >= self.queue_size:
+                if self.queue_policy == 'drop_newest':
+                    self.dropped += 1
+                    self.release(record)
+                    return self.current_ix + len(self.queue)
+                elif self.queue_policy == 'drop_oldest':
+                    self.dropped += 1
+                    self.release(self.queue.popleft()[1])
+                else:
+                    while len(self.queue) >= self.queue_size:
+                        self.queue_changed.wait()
+            self.queue.append((time.time(), record))
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, len(self.queue))
+            self.queue_changed.notify_all()
+            return self.current_ix + len(self.queue)
+
+    def copy_value(self, val):
+        if not isinstance(val, np.ndarray):
+            return val
+        free = self.buffers.get((val.shape, val.dtype.str))
+        buf = free.pop() if free else np.empty_like(val)
+        np.copyto(buf, val)
+        return buf
+
+    def release(self, record):
+        for val in record.values():
+            if isinstance(val, np.ndarray):
+                self.buffers.setdefault((val.shape, val.dtype.str), []).append(val)
+
+    def write_queued(self):
+        while True:
+            with self.queue_changed:
+                while self.running and not self.queue:
+                    self.queue_changed.wait()
+                if not self.queue:
+                    return
+                timestamp, record = self.queue.popleft()
+                self.writing = True
+                self.writing_ix = self.current_ix + 1
+                self.queue_changed.notify_all()
+            try:
+                self.put_record(record, timestamp=timestamp)
+            except Exception as e:
+                self.errors += 1
+                print('TubWriter failed to write a record:', e)
+            finally:
+                with self.queue_changed:
+                    self.writing = False
+                    self.release(record)
+                    self.queue_changed.notify_all()
+
+    def wait_until_written(self):
+        '''
+        wait for the queued records to be written.
+        '''
+        with self.queue_changed:
+            while self.queue or self.writing:
+                self.queue_changed.wait()
+
+    def erase_last_n_records(self, num_erase):
+        '''
+        erase the last records, dropping them from the queue first when
+        they haven't been written yet. With a manifest this doesn't wait
+        for the record being written, its tombstone covers it either way.
+        '''
+        with self.queue_changed:
+            while self.queue and num_erase > 0:
+                self.release(self.queue.pop()[1])
+                num_erase -= 1
+            if num_erase <= 0:
+                return
+            if self.manifest is not None:
+                last = self.writing_ix if self.writing else self.current_ix
+                self.erase_records(last - num_erase + 1, last)
+                return
+            while self.writing:
+                self.queue_changed.wait()
+            super(TubWriter, self).erase_last_n_records(num_erase)
+
+    def stats(self):
+        return {'queue_depth': len(self.queue),
+                'max_queue_depth': self.max_depth,
+                'enqueued': self.enqueued,
+                'dropped': self.dropped,
+                'errors': self.errors}
+
+    def shutdown(self):
+        if self.thread is not None:
+            with self.queue_changed:
+                self.running = False
+                self.queue_changed.notify_all()
+            self.thread.join()
+            self.thread = None
+            print('TubWriter queue:', self.stats())
+        super(TubWriter, self).shutdown()
 
 
 class TubReader(Tub):
@@ -604,9 +1638,10 @@ class TubHandler():
         tub_path = os.path.join(self.path, name)
         return tub_path
 
-    def new_tub_writer(self, inputs, types, user_meta=[]):
+    def new_tub_writer(self, inputs, types, user_meta=[], tub_format=None, queue_size=0, queue_policy='block'):
         tub_path = self.create_tub_path()
-        tw = TubWriter(path=tub_path, inputs=inputs, types=types, user_meta=user_meta)
+        tw = TubWriter(path=tub_path, inputs=inputs, types=types, user_meta=user_meta,
+                       tub_format=tub_format, queue_size=queue_size, queue_policy=queue_policy)
         return tw
 
 
@@ -711,7 +1746,7 @@ class TubTimeStacker(TubImageStacker):
 
                 #load only the first image saved as separate files
                 if typ == 'image' and i == 0:
-                    val = Image.open(os.path.join(self.path, val))
+                    val = open_image(os.path.join(self.path, val))
                     data[key] = val                    
                 elif typ == 'image_array' and i == 0:
                     d = super(TubTimeStacker, self).get_record(ix)
@@ -727,28 +1762,152 @@ class TubTimeStacker(TubImageStacker):
 
 
 class TubGroup(Tub):
+    '''
+    A lazy view of several tubs as one. Records are numbered 0..n-1 across
+    the tubs by a global index of (tub, record index) pairs, built from the
+    tubs' manifests, leaving out excluded records. Records and images are
+    only read when a batch needs them. df is still there for tools that
+    want every record, and is loaded on first use.
+    '''
     def __init__(self, tub_paths):
         tub_paths = self.resolve_tub_paths(tub_paths)
         print('TubGroup:tubpaths:', tub_paths)
-        tubs = [Tub(path) for path in tub_paths]
+        self.tubs = [Tub(path) for path in tub_paths]
         self.input_types = {}
 
-        record_count = 0
-        for t in tubs:
-            t.update_df()
-            record_count += len(t.df)
+        tub_ids = []
+        record_ixs = []
+        for i, t in enumerate(self.tubs):
+            index = [ix for ix in t.get_index(shuffled=False) if ix not in t.exclude]
+            tub_ids.append(np.full(len(index), i, dtype=np.int32))
+            record_ixs.append(np.array(index, dtype=np.int64))
             self.input_types.update(dict(zip(t.inputs, t.types)))
 
-        print('joining the tubs {} records together. This could take {} minutes.'.format(record_count,
-                                                                                         int(record_count / 300000)))
+        self.tub_ids = np.concatenate(tub_ids) if tub_ids else np.empty(0, dtype=np.int32)
+        self.record_ixs = np.concatenate(record_ixs) if record_ixs else np.empty(0, dtype=np.int64)
+        print('TubGroup: {} records in {} tubs.'.format(len(self), len(self.tubs)))
 
         self.meta = {'inputs': list(self.input_types.keys()),
                      'types': list(self.input_types.values())}
+        self._df = None
+
+    def __len__(self):
+        return len(self.record_ixs)
+
+    @property
+    def df(self):
+        if self._df is None:
+            self.update_df()
+        return self._df
+
+    @df.setter
+    def df(self, df):
+        self._df = df
+
+    def update_df(self):
+        import pandas as pd
+        dfs = []
+        for t in self.tubs:
+            t.update_df()
+            keep = [ix not in t.exclude for ix in t.get_index(shuffled=False)]
+            dfs.append(t.df[keep])
+        self._df = pd.concat(dfs, axis=0, join='inner', ignore_index=True)
+
+    def get_num_records(self):
+        return len(self)
+
+    def query(self, start=None, end=None, where=None):
+        '''
+        the global row numbers of the records matching Tub.query in each
+        tub, with start and end in milliseconds since each tub started.
+        the rows can be passed to get_batch_gen and get_train_gen.
+        '''
+        rows = []
+        for tub_id, tub in enumerate(self.tubs):
+            seg = np.nonzero(self.tub_ids == tub_id)[0]
+            if len(seg) == 0:
+                continue
+            seg_ixs = self.record_ixs[seg]
+            ixs = np.array(tub.query(start, end, where), dtype=np.int64)
+            pos = np.searchsorted(seg_ixs, ixs)
+            found = (pos < len(seg_ixs)) & (seg_ixs[np.minimum(pos, len(seg_ixs) - 1)] == ixs)
+            rows.append(seg[pos[found]])
+        return np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+
+    def get_records(self, rows):
+        '''
+        the records of the global row numbers, with absolute file names.
+        each tub reads its part of the rows in one go.
+        '''
+        rows = np.asarray(rows)
+        records = [None] * len(rows)
+        tub_ids = self.tub_ids[rows]
+        for tub_id in np.unique(tub_ids):
+            tub = self.tubs[tub_id]
+            where = np.nonzero(tub_ids == tub_id)[0]
+            ixs = [int(ix) for ix in self.record_ixs[rows[where]]]
+            for i, record in zip(where, tub.get_raw_json_records(ixs, workers=1)):
+                records[i] = tub.make_record_paths_absolute(record)
+        return records
 
+    def get_record(self, row):
+        return self.read_record(self.get_records([row])[0])
 
-        self.df = pd.concat([t.df for t in tubs], axis=0, join='inner')
+    def get_record_gen(self, record_transform=None, shuffle=True, rows=None):
+        if rows is None:
+            rows = np.arange(len(self))
 
+        for batch_rows in epoch_batches(len(rows), 1, shuffle):
+            record_dict = self.get_records(rows[batch_rows])[0]
 
+            if record_transform:
+                record_dict = record_transform(record_dict)
+
+            yield self.read_record(record_dict)
+
+    def get_batch_gen(self, keys, record_transform=None, batch_size=128, shuffle=True, rows=None):
+        '''
+        endlessly yield dicts of arrays of batch_size records, out of the
+        given global rows or every record, reading only the batch's
+        records and images.
+        '''
+        if rows is None:
+            rows = np.arange(len(self))
+
+        if keys == None:
+            keys = self.inputs
+
+        image_keys = [k for k in keys if self.get_input_type(k) == 'image_array']
+
+        for batch_rows in epoch_batches(len(rows), batch_size, shuffle):
+            record_list = self.get_records(rows[batch_rows])
+            if record_transform:
+                record_list = [record_transform(r) for r in record_list]
+            batch = {k: [r[k] for r in record_list] for k in keys}
+            yield self.stack_batch(batch, keys, image_keys)
+
+    def get_train_gen(self, X_keys, Y_keys, batch_size=128, record_transform=None, rows=None):
+
+        batch_gen = self.get_batch_gen(X_keys + Y_keys,
+                                       batch_size=batch_size, record_transform=record_transform, rows=rows)
+
+        while True:
+            batch = next(batch_gen)
+            X = [batch[k] for k in X_keys]
+            Y = [batch[k] for k in Y_keys]
+            yield X, Y
+
+    def get_train_val_gen(self, X_keys, Y_keys, batch_size=128, record_transform=None, train_frac=.8):
+        rows = np.random.RandomState(200).permutation(len(self))
+        num_train = int(len(rows) * train_frac)
+
+        train_gen = self.get_train_gen(X_keys=X_keys, Y_keys=Y_keys, batch_size=batch_size,
+                                       record_transform=record_transform, rows=rows[:num_train])
+
+        val_gen = self.get_train_gen(X_keys=X_keys, Y_keys=Y_keys, batch_size=batch_size,
+                                     record_transform=record_transform, rows=rows[num_train:])
+
+        return train_gen, val_gen
 
     def find_tub_paths(self, path):
         matches = []
@@ -760,9 +1919,151 @@ class TubGroup(Tub):
 
 
     def resolve_tub_paths(self, path_list):
-        path_list = path_list.split(",")
+        if type(path_list) == str:
+            path_list = path_list.split(",")
         resolved_paths = []
         for path in path_list:
             paths = self.find_tub_paths(path)
             resolved_paths += paths
         return resolved_paths
+
+
+#chunked tubs opened by load_json_record, by path.
+chunked_tubs = {}
+
+
+def load_json_record(record_path):
+    '''
+    load a record given a path from Tub.gather_records, with file names
+    relative to the tub like they are stored. Records of chunked tubs have
+    no file of their own, so they are read through the tub.
+    '''
+    if os.path.exists(record_path):
+        with open(record_path, 'r') as fp:
+            return json.load(fp)
+
+    tub_path = os.path.dirname(record_path)
+    tub = chunked_tubs.get(tub_path)
+    if tub is None:
+        tub = Tub(tub_path)
+        chunked_tubs[tub_path] = tub
+    ix = int(os.path.basename(record_path).split('_')[1].split('.')[0])
+    return tub.get_raw_json_record(ix)
+
+
+def convert_tub(src_path, dst_path, tub_format='chunked', chunk_size=1000, compact=False, image_size=None):
+    '''
+    Copy a tub to a new tub in another format, keeping record numbers,
+    timestamps, meta data and excluded records. Encoded images are copied
+    as they are, raw frames are encoded as they are copied.
+
+    compact : renumber the records from 1, leaving out excluded records and
+        records whose json or images can't be read.
+    image_size : (width, height) to resize images to, re-encoding them.
+    '''
+    src = Tub(src_path)
+    dst = Tub(dst_path, inputs=src.inputs, types=src.types, tub_format=tub_format,
+              chunk_size=chunk_size)
+    for k, v in src.meta.items():
+        if k not in ('format', 'chunk_size'):
+            dst.meta[k] = v
+    dst.start_time = src.start_time
+    dst.write_meta()
+
+    image_types = {'image': '.png', 'image_array': '.jpg'}
+    image_formats = {'image': 'png', 'image_array': 'jpeg'}
+    raw = dst.chunks is not None and dst.chunks.raw
+    for ix in src.get_index(shuffled=False):
+        if compact and ix in src.exclude:
+            continue
+
+        #read everything first, so a record that can't be read is left out whole.
+        try:
+            json_data = src.get_raw_json_record(ix)
+            images = {}
+            for key, val in json_data.items():
+                typ = src.get_input_type(key)
+                if typ not in image_types or not val:
+                    continue
+                path = os.path.join(src.path, val)
+                if raw or image_size is not None or RAW_FRAME_REF.match(path) is not None:
+                    img = open_image(path)
+                    img.load()
+                    if image_size is not None and img.size != tuple(image_size):
+                        img = img.resize(tuple(image_size))
+                    if raw:
+                        images[key] = np.asarray(img)
+                        continue
+                    f = BytesIO()
+                    img.save(f, format=image_formats[typ])
+                    images[key] = f.getvalue()
+                else:
+                    images[key] = read_image_bytes(path)
+        except (OSError, ValueError):
+            if not compact:
+                raise
+            print('dropping unreadable record:', src.path, ix)
+            continue
+
+        dst.current_ix = dst.current_ix + 1 if compact else ix
+        for key, data in images.items():
+            if raw:
+                json_data[key] = dst.chunks.append_frame(dst.current_ix, data)
+            elif dst.chunks is not None:
+                json_data[key] = dst.chunks.append_image(dst.current_ix, data)
+            else:
+                name = dst.make_file_name(key, ext=image_types[src.get_input_type(key)])
+                with open(os.path.join(dst.path, name), 'wb') as f:
+                    f.write(data)
+                json_data[key] = name
+        dst.write_json_record(json_data)
+        dst.manifest.add(dst.current_ix, json_data.get('milliseconds'), {k: json_data[k] for k in images})
+
+    if not compact:
+        dst.exclude = set(src.exclude)
+    dst.write_exclude()
+    dst.shutdown()
+    return dst
+
+
+def compact_tub(path, tub_format=None, image_size=None, keep_old=False):
+    '''
+    Rewrite a tub in place as a dense tub, numbered 1..n with no excluded
+    or unreadable records, and only the images its records use. The new
+    tub is written next to it and swapped in when complete. The old tub is
+    removed, or kept as <tub>.old, which must not exist yet.
+    '''
+    path = os.path.abspath(os.path.expanduser(path)).rstrip(os.sep)
+    if not os.path.isdir(path):
+        raise FileNotFoundError('no tub at %s' % path)
+    tmp_path = path + '.compacting'
+    #the old tub is moved aside before the new one is swapped in.
+    old_path = path + ('.old' if keep_old else '.replaced')
+    if keep_old and os.path.exists(old_path):
+        raise FileExistsError('%s already exists, move it before keeping another old tub' % old_path)
+    for leftover in (tmp_path, path + '.replaced'):
+        if os.path.exists(leftover):
+            shutil.rmtree(leftover)
+
+    src = Tub(path)
+    tub_format = tub_format or src.meta.get('format', 'files')
+    try:
+        convert_tub(path, tmp_path, tub_format=tub_format,
+                    chunk_size=src.meta.get('chunk_size', 1000),
+                    compact=True, image_size=image_size)
+        src.shutdown()
+
+        os.rename(path, old_path)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            os.rename(old_path, path)
+            raise
+    except BaseException:
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        raise
+
+    if not keep_old:
+        shutil.rmtree(old_path)
+    return Tub(path)
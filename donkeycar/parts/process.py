@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Run a part in its own worker process, so heavy parts like a keras pilot or
+a tub writer don't share the drive loop's GIL.
+
+Numpy arrays, like camera images, are passed between the processes through
+shared memory and only a small description of them goes over the pipe.
+Other values are pickled over the pipe as usual.
+"""
+import multiprocessing as mp
+import traceback
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    #python < 3.8. arrays are pickled over the pipe instead.
+    shared_memory = None
+
+
+class ShmWriter:
+    '''
+    Copies arrays into a shared memory block, growing it when an array
+    doesn't fit, and returns a description the other process can read
+    the array back from.
+    '''
+    def __init__(self):
+        self.shm = None
+
+    def write(self, arr):
+        if self.shm is None or self.shm.size < arr.nbytes:
+            self.close()
+            self.shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=self.shm.buf)
+        view[...] = arr
+        return ('shm', self.shm.name, arr.shape, arr.dtype.str)
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+class ShmReader:
+    '''
+    Reads arrays written by a ShmWriter in another process.
+    '''
+    def __init__(self):
+        self.blocks = {}
+
+    def read(self, desc):
+        _, name, shape, dtype = desc
+        shm = self.blocks.get(name)
+        if shm is None:
+            shm = shared_memory.SharedMemory(name=name)
+            self.blocks[name] = shm
+        view = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        #copy, so the part can keep the array after the block is reused.
+        return view.copy()
+
+    def close(self):
+        for shm in self.blocks.values():
+            shm.close()
+        self.blocks = {}
+
+
+class Channels:
+    '''
+    Packs values to send over a pipe, one ShmWriter per position so each
+    argument or output reuses its own block from call to call.
+    '''
+    def __init__(self, min_shm_bytes=1024):
+        self.min_shm_bytes = min_shm_bytes
+        self.writers = []
+        self.reader = ShmReader()
+
+    def pack(self, vals):
+        while len(self.writers) < len(vals):
+            self.writers.append(ShmWriter())
+        packed = []
+        for writer, val in zip(self.writers, vals):
+            if shared_memory is not None and isinstance(val, np.ndarray) \
+                    and val.nbytes >= self.min_shm_bytes:
+                packed.append(writer.write(val))
+            else:
+                packed.append(('val', val))
+        return packed
+
+    def unpack(self, packed):
+        return [self.reader.read(p) if p[0] == 'shm' else p[1] for p in packed]
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+        self.reader.close()
+
+
+def pack_outputs(channels, outputs):
+    if outputs is None:
+        return ('none', None)
+    if isinstance(outputs, (tuple, list)):
+        return ('many', channels.pack(outputs))
+    return ('one', channels.pack([outputs]))
+
+
+def unpack_outputs(channels, msg):
+    kind, packed = msg
+    if kind == 'none':
+        return None
+    vals = channels.unpack(packed)
+    if kind == 'many':
+        return tuple(vals)
+    return vals[0]
+
+
+def worker_loop(conn, part):
+    '''
+    runs in the worker process. If part has no run method it is called
+    first to make the part, so parts that can't be copied to a new process
+    can be built there instead.
+    '''
+    if not hasattr(part, 'run'):
+        part = part()
+    channels = Channels()
+
+    try:
+        while True:
+            msg = conn.recv()
+            if msg is None:
+                break
+            try:
+                outputs = part.run(*channels.unpack(msg))
+                conn.send(('ok', pack_outputs(channels, outputs)))
+            except Exception:
+                conn.send(('error', traceback.format_exc()))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        try:
+            part.shutdown()
+        except AttributeError:
+            pass
+        channels.close()
+        conn.close()
+
+
+class ProcessPart:
+    """
+    Wraps a part so its run method is called in a worker process.
+
+    part : a part, or a class or function that returns one. Pass a class
+        or function when the part holds things that don't survive being
+        copied to a new process, like a tensorflow session.
+
+    Add it to the vehicle like any other part. Used as a plain part, run
+    blocks until the worker returns the outputs. Added with threaded=True,
+    run_threaded hands the inputs to the worker when it's idle and returns
+    the most recent outputs without waiting, so the outputs lag by a loop
+    or more but the drive loop never waits on the worker.
+    """
+    def __init__(self, part, min_shm_bytes=1024):
+        self.name = getattr(part, '__name__', part.__class__.__name__)
+        self.channels = Channels(min_shm_bytes)
+        if shared_memory is not None:
+            #share one tracker with the worker so blocks attached on both
+            #sides aren't reported as leaked.
+            resource_tracker.ensure_running()
+        self.conn, child_conn = mp.Pipe()
+        self.proc = mp.Process(target=worker_loop, args=(child_conn, part))
+        self.proc.daemon = True
+        self.proc.start()
+        child_conn.close()
+        self.busy = False
+        self.outputs = None
+
+    def send(self, args):
+        self.conn.send(self.channels.pack(args))
+        self.busy = True
+
+    def receive(self):
+        status, msg = self.conn.recv()
+        self.busy = False
+        if status == 'error':
+            raise RuntimeError('ProcessPart %s failed:\n%s' % (self.name, msg))
+        self.outputs = unpack_outputs(self.channels, msg)
+        return self.outputs
+
+    def run(self, *args):
+        if self.busy:
+            self.receive()
+        self.send(args)
+        return self.receive()
+
+    def update(self):
+        pass
+
+    def run_threaded(self, *args):
+        if self.busy and self.conn.poll():
+            self.receive()
+        if not self.busy:
+            self.send(args)
+        return self.outputs
+
+    def shutdown(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.proc.join(timeout=5)
+        if self.proc.is_alive():
+            self.proc.terminate()
+        self.channels.close()
+        self.conn.close()
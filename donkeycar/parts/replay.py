@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Record the values of vehicle memory channels on every loop and feed them
+back into a vehicle later, so a drive can be re-run offline against a new
+pilot, filter or actuator mix.
+
+Records are appended to one file as a stream of pickles. The first holds
+the channel names, each one after it the loop time and channel values.
+"""
+import os
+import time
+import pickle
+
+
+class MemoryRecorder:
+    '''
+    A part that records its inputs on every loop. Add it with the channels
+    to record as inputs, usually at the end of the vehicle.
+
+    >>> keys = ['cam/image_array', 'user/angle', 'user/throttle', 'user/mode']
+    >>> V.add(MemoryRecorder('~/d2/drive.replay', keys), inputs=keys)
+    '''
+    def __init__(self, path, keys):
+        self.path = os.path.expanduser(path)
+        self.keys = list(keys)
+        self.f = open(self.path, 'wb')
+        pickle.dump({'keys': self.keys}, self.f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.start_time = None
+
+    def run(self, *values):
+        now = time.perf_counter()
+        if self.start_time is None:
+            self.start_time = now
+        pickle.dump((now - self.start_time, values), self.f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def shutdown(self):
+        self.f.close()
+
+
+class MemoryReplay:
+    '''
+    A part that outputs recorded channel values, one loop's worth per run.
+    Add it first, with its keys as outputs, in place of the live parts that
+    produced them.
+
+    realtime : when True, run waits until the recorded time of each loop
+        so the drive replays at its original timing. Otherwise records are
+        returned as fast as the vehicle asks for them.
+    vehicle : when given, it is stopped after the last record.
+    '''
+    def __init__(self, path, realtime=False, vehicle=None):
+        self.path = os.path.expanduser(path)
+        self.realtime = realtime
+        self.vehicle = vehicle
+        self.f = open(self.path, 'rb')
+        self.keys = pickle.load(self.f)['keys']
+        self.start_time = None
+        self.done = False
+
+    def next_record(self):
+        try:
+            return pickle.load(self.f)
+        except EOFError:
+            self.done = True
+            if self.vehicle is not None:
+                self.vehicle.on = False
+            return None
+
+    def run(self):
+        rec = self.next_record()
+        if rec is None:
+            return None
+
+        t, values = rec
+        if self.realtime:
+            now = time.perf_counter()
+            if self.start_time is None:
+                self.start_time = now - t
+            wait = self.start_time + t - now
+            if wait > 0.0:
+                time.sleep(wait)
+
+        if len(values) == 1:
+            return values[0]
+        return values
+
+    def shutdown(self):
+        self.f.close()
+
+
+def replay(vehicle, path, realtime=False):
+    '''
+    Drive a vehicle from a recording, one loop per record, on this thread.
+    The vehicle should not contain the live parts whose channels were
+    recorded, and its threaded parts are not started, so the same
+    recording gives the same results every time. Returns the number of
+    loops and loops per second.
+    '''
+    source = MemoryReplay(path, realtime=realtime)
+    writer = vehicle.mem.writer(source.keys)
+    start = time.perf_counter()
+    loops = 0
+
+    try:
+        while True:
+            values = source.run()
+            if source.done:
+                break
+            writer(values)
+            loops += 1
+            vehicle.loop_count = loops
+            vehicle.update_parts()
+    finally:
+        source.shutdown()
+
+    elapsed = time.perf_counter() - start
+    return {'loops': loops,
+            'seconds': elapsed,
+            'loops_per_sec': loops / elapsed if elapsed > 0 else 0.0}
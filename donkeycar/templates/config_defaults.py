@@ -32,6 +32,13 @@ MODELS_PATH = os.path.join(CAR_PATH, 'models')
 #VEHICLE
 DRIVE_LOOP_HZ = 20
 MAX_LOOPS = 100000
+DRIVE_LOOP_SPIN_TIME = 0.0      #seconds before each loop deadline to busy wait instead of sleep. try 0.001 for steadier timing.
+DRIVE_LOOP_PARALLEL = False     #run parts that don't share channels at the same time on a thread pool.
+DRIVE_LOOP_WORKERS = 4          #threads in that pool.
+DRIVE_LOOP_ON_FRAME = False     #start each loop when the camera has a new frame. DRIVE_LOOP_HZ becomes the max rate.
+FRAME_TIMEOUT = 0.1             #seconds to wait for a frame before running the loop anyway.
+TRACE_PATH = None               #file to write a chrome trace of part runs to. open in chrome://tracing
+TRACE_FLUSH_ON_OVERRUN = True   #write the recent trace whenever a loop misses its deadline
 
 #CAMERA
 CAMERA_TYPE = "PICAM"   # (PICAM|WEBCAM|CVCAM|MOCK)
@@ -126,6 +133,10 @@ HAVE_SOMBRERO = False
 
 #RECORD OPTIONS
 RECORD_DURING_AI = False
+TUB_FORMAT = 'files'            #'files' writes a json and jpg per record. 'chunked' appends them to a few large files.
+                                #'raw' is chunked with unencoded frames, for the least cpu. encode later with donkey tubencode.
+TUB_WRITE_QUEUE = 0             #records to queue for a background thread to write. 0 writes them in the drive loop.
+TUB_WRITE_POLICY = 'block'      #when the queue is full: 'block' waits, 'drop_newest' or 'drop_oldest' drop a record.
 USE_REWARDS = False
 
 #LED
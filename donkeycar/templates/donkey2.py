@@ -57,6 +57,13 @@ def drive(cfg, model_path=None, use_joystick=False, model_type=None, camera_type
     #Initialize car
     V = dk.vehicle.Vehicle()
 
+    if cfg.TRACE_PATH:
+        from donkeycar.vehicle import PartTracer
+        V.tracer = PartTracer(cfg.TRACE_PATH, flush_on_overrun=cfg.TRACE_FLUSH_ON_OVERRUN)
+
+    #the camera to start each loop on, when DRIVE_LOOP_ON_FRAME
+    frame_source = None
+
     if camera_type == "stereo":
 
         if cfg.CAMERA_TYPE == "WEBCAM":
@@ -107,6 +114,12 @@ def drive(cfg, model_path=None, use_joystick=False, model_type=None, camera_type
             raise(Exception("Unkown camera type: %s" % cfg.CAMERA_TYPE))
             
         V.add(cam, inputs=inputs, outputs=['cam/image_array'], threaded=threaded)
+
+        if cfg.DRIVE_LOOP_ON_FRAME:
+            if getattr(cam, 'publishes_frames', False):
+                frame_source = cam
+            else:
+                print('%s does not publish frames, running the drive loop at DRIVE_LOOP_HZ.' % cam.__class__.__name__)
         
     if use_joystick or cfg.USE_JOYSTICK_AS_DEFAULT:
         #modify max_throttle closer to 1.0 to have more power
@@ -362,9 +375,11 @@ def drive(cfg, model_path=None, use_joystick=False, model_type=None, camera_type
         if cfg.TRAIN_LOCALIZER:
             outputs.append("pilot/loc")
     
+        #only run inference when the camera has a new frame.
         V.add(kl, inputs=inputs, 
             outputs=outputs,
-            run_condition='run_pilot')            
+            run_condition='run_pilot',
+            triggers=['cam/image_array'])            
     
     #Choose what inputs should change the car.
     class DriveMode:
@@ -498,6 +513,9 @@ def drive(cfg, model_path=None, use_joystick=False, model_type=None, camera_type
             import json
             if self.tub is None:
                 return
+            if self.tub.chunks is not None:
+                print("can't write rewards to a chunked tub. set TUB_FORMAT = 'files'")
+                return
             iRecord = self.tub.current_ix
             iStop = iRecord - self.neg_time_ramp_steps
             reward = self.max_neg
@@ -548,8 +566,9 @@ def drive(cfg, model_path=None, use_joystick=False, model_type=None, camera_type
         types += ['float', 'float']
     
     th = TubHandler(path=cfg.DATA_PATH)
-    tub = th.new_tub_writer(inputs=inputs, types=types, user_meta=meta)
-    V.add(tub, inputs=inputs, outputs=["tub/num_records"], run_condition='recording')
+    tub = th.new_tub_writer(inputs=inputs, types=types, user_meta=meta, tub_format=cfg.TUB_FORMAT,
+                            queue_size=cfg.TUB_WRITE_QUEUE, queue_policy=cfg.TUB_WRITE_POLICY)
+    tub_entry = V.add(tub, inputs=inputs, outputs=["tub/num_records"], run_condition='recording')
 
     if cfg.PUB_CAMERA_IMAGES:
         from donkeycar.parts.network import TCPServeValue
@@ -573,16 +592,28 @@ def drive(cfg, model_path=None, use_joystick=False, model_type=None, camera_type
         if cfg.BUTTON_PRESS_NEW_TUB:
     
             def new_tub_dir():
-                V.parts.pop()
-                tub = th.new_tub_writer(inputs=inputs, types=types, user_meta=meta)
-                V.add(tub, inputs=inputs, outputs=["tub/num_records"], run_condition='recording')
+                #the tub writer isn't always the last part, so keep its entry.
+                nonlocal tub_entry
+                V.remove(tub_entry)
+                #finish writing any queued records.
+                tub_entry['part'].shutdown()
+                tub = th.new_tub_writer(inputs=inputs, types=types, user_meta=meta, tub_format=cfg.TUB_FORMAT,
+                                    queue_size=cfg.TUB_WRITE_QUEUE, queue_policy=cfg.TUB_WRITE_POLICY)
+                tub_entry = V.add(tub, inputs=inputs, outputs=["tub/num_records"], run_condition='recording')
                 ctr.set_tub(tub)
+                if cfg.USE_REWARDS:
+                    rewardSig.set_tub(tub)
     
             ctr.set_button_down_trigger('cross', new_tub_dir)
 
     #run the vehicle for 20 seconds
     V.start(rate_hz=cfg.DRIVE_LOOP_HZ, 
-            max_loop_count=cfg.MAX_LOOPS)
+            max_loop_count=cfg.MAX_LOOPS,
+            spin_time=cfg.DRIVE_LOOP_SPIN_TIME,
+            parallel=cfg.DRIVE_LOOP_PARALLEL,
+            max_workers=cfg.DRIVE_LOOP_WORKERS,
+            frame_source=frame_source,
+            frame_timeout=cfg.FRAME_TIMEOUT)
 
 
 if __name__ == '__main__':
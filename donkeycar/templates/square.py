@@ -140,7 +140,7 @@ def train(cfg, tub_names, model_name):
 
     model_path = os.path.expanduser(model_name)
 
-    total_records = len(tubgroup.df)
+    total_records = len(tubgroup)
     total_train = int(total_records * cfg.TRAIN_TEST_SPLIT)
     total_val = total_records - total_train
     print('train: %d, validation: %d' % (total_train, total_val))
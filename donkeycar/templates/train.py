@@ -12,10 +12,12 @@ You might need to do a: pip install scikit-learn
 
 Usage:
     train.py [--tub=<tub1,tub2,..tubn>] [--file=<file> ...] (--model=<model>) [--transfer=<model>] [--type=(linear|latent|categorical|rnn|imu|behavior|3d|look_ahead)] [--continuous] [--aug]
+    train.py --dataset=<path> (--model=<model>) [--transfer=<model>] [--type=(linear|categorical|imu|behavior)] [--aug]
 
 Options:
     -h --help        Show this screen.
     -f --file=<file> A text file containing paths to tub files, one per line. Option may be used more than once.
+    --dataset=<path> Train on a dataset made by donkey makedataset instead of tubs.
 """
 import os
 import glob
@@ -32,7 +34,7 @@ import keras
 import pickle
 
 import donkeycar as dk
-from donkeycar.parts.datastore import Tub
+from donkeycar.parts.datastore import Tub, load_json_record
 from donkeycar.parts.keras import KerasLinear, KerasIMU,\
      KerasCategorical, KerasBehavioral, Keras3D_CNN,\
      KerasRNN_LSTM, KerasLatent
@@ -126,8 +128,7 @@ def collate_records(records, gen_records, opts):
             continue
 
         try:
-            with open(record_path, 'r') as fp:
-                json_data = json.load(fp)
+            json_data = load_json_record(record_path)
         except:
             continue
 
@@ -412,7 +413,8 @@ def train(cfg, tub_names, model_name, transfer_model, model_type, continuous, au
 
                 if continuous:
                     #in continuous mode we need to handle files getting deleted
-                    filename = _record['image_path']
+                    #images of chunked tubs are named <chunk file>#<offset>:<length>
+                    filename = _record['image_path'].split('#')[0]
                     if not os.path.exists(filename):
                         data.pop(key, None)
                         continue
@@ -703,10 +705,9 @@ def sequence_train(cfg, tub_names, model_name, transfer_model, model_type, conti
     records = []
 
     for tub in tubs:
-        record_paths = glob.glob(os.path.join(tub.path, 'record_*.json'))
+        record_paths = tub.gather_records()
         print("Tub:", tub.path, "has", len(record_paths), 'records')
 
-        record_paths.sort(key=get_record_index)
         records += record_paths
 
 
@@ -715,8 +716,7 @@ def sequence_train(cfg, tub_names, model_name, transfer_model, model_type, conti
 
     for record_path in records:
 
-        with open(record_path, 'r') as fp:
-            json_data = json.load(fp)
+        json_data = load_json_record(record_path)
 
         basepath = os.path.dirname(record_path)
         image_filename = json_data["cam/image_array"]
@@ -724,7 +724,7 @@ def sequence_train(cfg, tub_names, model_name, transfer_model, model_type, conti
         sample = { 'record_path' : record_path, "image_path" : image_path, "json_data" : json_data }
 
         sample["tub_path"] = basepath
-        sample["index"] = get_image_index(image_filename)
+        sample["index"] = get_record_index(record_path)
 
         angle = float(json_data['user/angle'])
         throttle = float(json_data["user/throttle"])
@@ -883,6 +883,109 @@ def sequence_train(cfg, tub_names, model_name, transfer_model, model_type, conti
     '''
 
 
+def dataset_train(cfg, dataset_path, model_name, transfer_model, model_type, aug):
+    '''
+    train on a dataset compiled by donkey makedataset. batches are sliced
+    out of the memory mapped columns, so there is no per record parsing.
+    '''
+    from donkeycar.parts.dataset import Dataset
+
+    verbose = cfg.VEBOSE_TRAIN
+    ds = Dataset(dataset_path)
+
+    kl = get_model_by_type(model_type, cfg=cfg)
+    categorical = type(kl) in [KerasCategorical, KerasBehavioral]
+    has_imu = type(kl) is KerasIMU
+    has_bvh = type(kl) is KerasBehavioral
+
+    if type(kl) is KerasLatent:
+        raise Exception("latent models aren't supported when training from a dataset, use --tub")
+    if cfg.PRUNE_CNN:
+        raise Exception("PRUNE_CNN isn't supported when training from a dataset, use --tub")
+    if has_bvh and 'behavior' not in ds.columns:
+        raise Exception("dataset %s has no behavior column" % dataset_path)
+    if tuple(ds.meta['image_shape']) != (cfg.IMAGE_H, cfg.IMAGE_W, cfg.IMAGE_DEPTH):
+        raise Exception("dataset images are %s, config wants %s" %
+                        (ds.meta['image_shape'], [cfg.IMAGE_H, cfg.IMAGE_W, cfg.IMAGE_DEPTH]))
+
+    print('training with model type', type(kl))
+
+    if transfer_model:
+        print('loading weights from model', transfer_model)
+        kl.load(transfer_model)
+
+        if cfg.FREEZE_LAYERS:
+            num_to_freeze = len(kl.model.layers) - cfg.NUM_LAST_LAYERS_TO_TRAIN
+            print('freezing %d layers' % num_to_freeze)
+            for i in range(num_to_freeze):
+                kl.model.layers[i].trainable = False
+
+    if cfg.OPTIMIZER:
+        kl.set_optimizer(cfg.OPTIMIZER, cfg.LEARNING_RATE, cfg.LEARNING_RATE_DECAY)
+
+    kl.compile()
+
+    if cfg.PRINT_MODEL_SUMMARY:
+        print(kl.model.summary())
+
+    if type(kl.model.output) is list:
+        model_out_shape = (2, 1)
+    else:
+        model_out_shape = kl.model.output.shape
+
+    rows = np.arange(len(ds))
+    if has_imu:
+        #records without imu readings can't train an imu model
+        rows = rows[~np.isnan(ds['imu']).any(axis=1)]
+    train_rows, val_rows = train_test_split(rows, train_size=cfg.TRAIN_TEST_SPLIT)
+
+    columns = ['images', 'angle', 'throttle']
+    if has_imu:
+        columns.append('imu')
+    if has_bvh:
+        columns.append('behavior')
+
+    def generator(rows, batch_size, isTrainSet=True):
+        for batch in ds.batch_gen(rows, batch_size, columns):
+            img_arr = batch['images']
+            if aug and isTrainSet:
+                img_arr = np.array([augment_image(img) for img in img_arr])
+
+            angles = batch['angle']
+            throttles = batch['throttle']
+            if categorical:
+                angles = np.array([dk.utils.linear_bin(a) for a in angles])
+                throttles = np.array([dk.utils.linear_bin(t, N=20, offset=0, R=cfg.MODEL_CATEGORICAL_MAX_THROTTLE_RANGE)
+                                      for t in throttles])
+
+            if has_imu:
+                X = [img_arr, batch['imu']]
+            elif has_bvh:
+                X = [img_arr, batch['behavior']]
+            else:
+                X = [img_arr]
+
+            if model_out_shape[1] == 2:
+                y = [np.array([angles, throttles])]
+            else:
+                y = [angles, throttles]
+
+            yield X, y
+
+    train_gen = generator(train_rows, cfg.BATCH_SIZE, True)
+    val_gen = generator(val_rows, cfg.BATCH_SIZE, False)
+
+    print("train: %d, val: %d" % (len(train_rows), len(val_rows)))
+    print('total records: %d' % len(ds))
+
+    steps_per_epoch = len(train_rows) // cfg.BATCH_SIZE
+    #a validation split smaller than a batch is one short batch.
+    val_steps = max(1, len(val_rows) // cfg.BATCH_SIZE)
+    print('steps_per_epoch', steps_per_epoch)
+
+    go_train(kl, cfg, train_gen, val_gen, None, model_name, steps_per_epoch, val_steps, False, verbose)
+
+
 def multi_train(cfg, tub, model, transfer, model_type, continuous, aug):
     '''
     choose the right regime for the given model type
@@ -1019,7 +1122,11 @@ if __name__ == "__main__":
     model_type = args['--type']
     continuous = args['--continuous']
     aug = args['--aug']
-    
+
+    if args['--dataset']:
+        dataset_train(cfg, args['--dataset'], model, transfer, model_type, aug)
+        exit(0)
+
     dirs = preprocessFileList( args['--file'] )
     if tub is not None:
         tub_paths = [os.path.expanduser(n) for n in tub.split(',')]
@@ -1 +1,52 @@
+import os
+import numpy as np
+import donkeycar as dk
+from donkeycar.parts.process import ProcessPart
+from donkeycar.parts.transform import Lambda
 
+
+def flip(img, x):
+    return img[::-1].copy(), x + 1
+
+
+def test_process_part():
+    p = ProcessPart(Lambda(flip))
+    img = np.arange(120 * 160 * 3, dtype=np.uint8).reshape(120, 160, 3)
+    out, x = p.run(img, 1)
+    p.shutdown()
+    assert x == 2
+    assert np.array_equal(out, img[::-1])
+
+
+def test_process_part_in_vehicle():
+    v = dk.Vehicle()
+    v.mem['img'] = np.ones((120, 160, 3), dtype=np.uint8)
+    v.add(Lambda(lambda img: img.sum()), inputs=['img'], outputs=['sum'], process=True)
+    v.add(Lambda(os.getpid), outputs=['pid'], process=True)
+    v.start(rate_hz=50, max_loop_count=2)
+    assert v.mem['sum'] == 120 * 160 * 3
+    assert v.mem['pid'] != os.getpid()
+
+
+def test_memory_record_replay(tmpdir):
+    from donkeycar.parts.replay import MemoryRecorder, MemoryReplay, replay
+    path = str(tmpdir.join('drive.replay'))
+
+    v = dk.Vehicle()
+    v.add(Lambda(lambda: v.loop_count), outputs=['user/angle'])
+    v.add(Lambda(lambda: np.full((2, 2), v.loop_count)), outputs=['cam/image_array'])
+    v.add(MemoryRecorder(path, ['user/angle', 'cam/image_array']),
+          inputs=['user/angle', 'cam/image_array'])
+    v.start(rate_hz=100, max_loop_count=4)
+
+    v2 = dk.Vehicle()
+    v2.add(Lambda(lambda a, img: a + img.sum()), inputs=['user/angle', 'cam/image_array'], outputs=['out'])
+    stats = replay(v2, path)
+    assert stats['loops'] == 5
+    assert v2.mem['out'] == 25
+
+    v3 = dk.Vehicle()
+    v3.add(MemoryReplay(path, realtime=True, vehicle=v3), outputs=['user/angle', 'cam/image_array'])
+    v3.start(rate_hz=1000)
+    assert v3.mem['user/angle'] == 5
+    assert v3.loop_timer.stats()['avg_period'] > 5.0
@@ -9,6 +9,12 @@ def test_base_camera():
     cam = BaseCamera()
 
 
+def test_cameras_publishing_frames():
+    from donkeycar.parts.camera import PiCamera, Webcam, MockCamera, ImageListCamera
+    assert PiCamera.publishes_frames and Webcam.publishes_frames
+    assert not MockCamera.publishes_frames and not ImageListCamera.publishes_frames
+
+
 @pytest.mark.skipif(on_pi() == False, reason='only works on RPi')
 def test_picamera():
     from donkeycar.parts.camera import PiCamera
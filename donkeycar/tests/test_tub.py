@@ -2,7 +2,7 @@
 import tempfile
 import unittest
 from donkeycar.parts.datastore import TubWriter, Tub
-from donkeycar.parts.datastore import TubHandler
+from donkeycar.parts.datastore import TubHandler, convert_tub, load_json_record
 import os
 
 import pytest
@@ -64,6 +64,302 @@ def test_tub_exclude(tub):
     assert len(diff) == 1
     assert 1 in diff # Make sure we exclude the correct index
 
+def test_tub_chunked(tub, tub_path):
+    """ A tub converted to chunks reads the same, and survives reopening and erasing """
+    import numpy as np
+    chunked = convert_tub(tub_path, tub_path + '_chunked', chunk_size=50)
+    t = Tub(chunked.path)
+    assert t.chunks is not None
+    assert t.get_num_records() == tub.get_num_records()
+    assert len([f for f in os.listdir(t.path) if f.startswith('chunk_') and f.endswith('.jsonl')]) == 3
+
+    rec_in = tub.get_record(60)
+    rec_out = t.get_record(60)
+    assert np.array_equal(rec_in['cam/image_array'], rec_out['cam/image_array'])
+    assert rec_in['user/angle'] == rec_out['user/angle']
+
+    ix = t.put_record({'cam/image_array': np.zeros((120, 160, 3)), 'user/angle': 0.5, 'user/throttle': 0.2})
+    assert t.get_record(ix)['user/angle'] == 0.5
+    t.erase_last_n_records(10)
+    assert max(t.get_index()) == t.current_ix - 10
+    t.shutdown()
+
+    t2 = Tub(chunked.path)
+    assert t2.get_num_records() == t.get_num_records()
+    paths = t2.gather_records()
+    assert load_json_record(paths[0])['user/angle'] == tub.get_record(1)['user/angle']
+
+
+def test_tub_manifest(tub, tub_path):
+    """ The manifest lists the same records as the tub's files, and can be rebuilt """
+    tub.exclude_index(3)
+    tub.write_exclude()
+    image_5 = tub.get_json_record(5)['cam/image_array']
+    tub.remove_record(5)
+    assert not os.path.exists(image_5)
+    tub.erase_last_n_records(10)
+    tub.put_record({'user/angle': 0.5, 'user/throttle': 0.2})
+
+    t = Tub(tub_path)
+    assert t.manifest.records is None # opened from the end of the manifest
+    assert t.current_ix == tub.current_ix + 1
+    #erased records stay on disk until the tub is compacted
+    assert sorted(t.get_index()) == [ix for ix in sorted(t.scan_index()) if ix not in range(119, 129)]
+    assert t.get_num_records() == 128 - 10 - 1 + 1
+    assert t.manifest.exclude == {3}
+
+    rebuilt = Tub(tub_path).rebuild_manifest()
+    assert sorted(rebuilt.indexes()) == sorted(t.get_index())
+
+    for ix in range(119, 129):
+        Tub(tub_path).erase_record(ix)
+    os.unlink(t.manifest.path)
+    assert Tub(tub_path).manifest is None
+    rebuilt = Tub(tub_path).rebuild_manifest()
+    assert sorted(rebuilt.indexes()) == sorted(t.get_index())
+    assert rebuilt.exclude == {3}
+
+
+def test_tub_raw(tub, tub_path):
+    """ A raw tub keeps frames as they are, and can be encoded back to jpgs """
+    import numpy as np
+    raw = convert_tub(tub_path, tub_path + '_raw', tub_format='raw', chunk_size=50)
+    raw.shutdown()
+    t = Tub(raw.path)
+    assert np.array_equal(t.get_record(70)['cam/image_array'], tub.get_record(70)['cam/image_array'])
+
+    frame = np.full((120, 160, 3), 9, dtype=np.uint8)
+    ix = t.put_record({'cam/image_array': frame, 'user/angle': 0.5, 'user/throttle': 0.2})
+    assert np.array_equal(t.get_record(ix)['cam/image_array'], frame)
+    t.shutdown()
+
+    encoded = convert_tub(raw.path, tub_path + '_encoded')
+    t2 = Tub(encoded.path)
+    assert t2.meta['format'] == 'chunked'
+    assert t2.get_num_records() == 129
+    assert abs(t2.get_record(ix)['cam/image_array'].mean() - 9) < 1
+
+
+@pytest.mark.parametrize('policy', ['block', 'drop_newest', 'drop_oldest'])
+def test_tub_writer_queue(tub_path, policy):
+    """ A queued TubWriter writes records in order, dropping them by its policy """
+    import numpy as np
+    img = np.zeros((120, 160, 3), dtype=np.uint8)
+    t = TubWriter(tub_path, inputs=['cam/image_array', 'user/angle'], types=['image_array', 'float'],
+                  queue_size=4, queue_policy=policy)
+    for i in range(50):
+        img[0, 0, 0] = i
+        t.run(img, float(i))
+    t.erase_last_n_records(2)
+    t.shutdown()
+
+    stats = t.stats()
+    r = Tub(tub_path)
+    index = sorted(r.get_index())
+    angles = [r.get_record(ix)['user/angle'] for ix in index]
+    assert angles == sorted(angles)
+    assert len(index) == 50 - stats['dropped'] - 2
+    if policy == 'block':
+        assert stats['dropped'] == 0
+        assert angles == [float(i) for i in range(48)]
+
+
+def test_tub_erase_tombstone(tub, tub_path):
+    """ Erasing appends a tombstone, record numbers aren't reused and compaction deletes the files """
+    from donkeycar.parts.datastore import compact_tub
+    files = len(os.listdir(tub_path))
+    tub.erase_last_n_records(100)
+    assert len(os.listdir(tub_path)) == files
+    assert tub.get_num_records() == 28
+    with pytest.raises(FileNotFoundError):
+        tub.get_record(50)
+
+    t = Tub(tub_path)
+    ix = t.put_record({'user/angle': 0.5, 'user/throttle': 0.2})
+    assert ix > 128
+    assert sorted(Tub(tub_path).get_index()) == list(range(1, 29)) + [ix]
+
+    compacted = compact_tub(tub_path)
+    assert compacted.get_num_records() == 29
+    assert len([f for f in os.listdir(tub_path) if f.startswith('record_')]) == 29
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_tub_update_df_matches_records(tub, tmpdir, workers):
+    """ update_df loads the same records as get_json_record, for files and chunked tubs """
+    import pandas as pd
+    chunked = convert_tub(tub.path, str(tmpdir.join('chunked')), chunk_size=50)
+    for t in (tub, chunked):
+        t.update_df(workers=workers)
+        expected = pd.DataFrame([t.get_json_record(ix) for ix in t.get_index(shuffled=False)])
+        assert t.df.equals(expected)
+        assert t.df['cam/image_array'][0].startswith(t.path)
+
+
+def test_tub_batch_gen(tub):
+    """ Batches use every record once per epoch and apply the record transform """
+    import numpy as np
+    tub.update_df()
+    gen = tub.get_batch_gen(['user/angle', 'cam/image_array'], batch_size=32)
+    batches = [next(gen) for _ in range(4)]
+    angles = np.concatenate([b['user/angle'] for b in batches])
+    assert sorted(angles) == sorted(tub.df['user/angle'])
+    assert batches[0]['cam/image_array'].shape == (32, 120, 160, 3)
+
+    def rt(record):
+        record['angle_bin'] = [record['user/angle'], 1.0]
+        return record
+    batch = next(tub.get_batch_gen(['angle_bin'], record_transform=rt, batch_size=200, shuffle=False))
+    assert batch['angle_bin'].shape == (200, 2)
+    assert list(batch['angle_bin'][128:, 0]) == list(tub.df['user/angle'][:72])
+
+
+def test_tub_group(tub, tmpdir):
+    """ TubGroup indexes the records of its tubs and reads them by batch """
+    from donkeycar.parts.datastore import TubGroup
+    chunked = convert_tub(tub.path, str(tmpdir.join('chunked')), chunk_size=50)
+    chunked.exclude_index(3)
+    chunked.write_exclude()
+
+    tg = TubGroup([tub.path, chunked.path])
+    assert len(tg) == 255
+    assert len(tg.df) == 255
+    assert list(tg.record_ixs[127:131]) == [128, 1, 2, 4]
+    assert tg.get_record(130)['user/angle'] == chunked.get_record(4)['user/angle']
+
+    train_gen, val_gen = tg.get_train_val_gen(['cam/image_array'], ['user/angle'], batch_size=100)
+    X, Y = next(train_gen)
+    assert X[0].shape == (100, 120, 160, 3)
+    assert Y[0].shape == (100,)
+
+    batch = next(tg.get_batch_gen(['user/angle'], batch_size=255, shuffle=False))
+    assert list(batch['user/angle']) == list(tg.df['user/angle'])
+
+
+@pytest.mark.parametrize('tub_format', ['files', 'chunked'])
+def test_tub_compact(tub, tub_path, tub_format):
+    """ Compacting drops excluded and unreadable records and renumbers the rest """
+    from donkeycar.parts.datastore import compact_tub
+    angles = {ix: tub.get_record(ix)['user/angle'] for ix in tub.get_index()}
+    tub.exclude_index(3)
+    tub.write_exclude()
+    os.unlink(os.path.join(tub.path, load_json_record(tub.get_json_record_path(10))['cam/image_array']))
+    os.unlink(os.path.join(tub.path, 'record_20.json'))
+
+    t = compact_tub(tub_path, tub_format=tub_format, image_size=(80, 60), keep_old=True)
+    assert t.meta.get('format', 'files') == tub_format
+    assert sorted(t.get_index()) == list(range(1, 126))
+    assert t.exclude == set()
+    kept = [ix for ix in range(1, 129) if ix not in (3, 10, 20)]
+    assert [t.get_record(ix)['user/angle'] for ix in (1, 3, 100)] == [angles[kept[i - 1]] for i in (1, 3, 100)]
+    assert t.get_record(5)['cam/image_array'].shape == (60, 80, 3)
+    assert os.path.exists(tub_path + '.old')
+    if tub_format == 'files':
+        assert len([f for f in os.listdir(t.path) if f.endswith('.jpg')]) == 125
+
+    #an old tub from an earlier run isn't replaced, and nothing is left behind.
+    with pytest.raises(FileExistsError):
+        compact_tub(tub_path, keep_old=True)
+    t = compact_tub(tub_path)
+    assert sorted(t.get_index()) == list(range(1, 126))
+    assert not os.path.exists(tub_path + '.compacting')
+    assert not os.path.exists(tub_path + '.replaced')
+    assert os.path.exists(tub_path + '.old')
+
+
+def test_tub_check(tub):
+    """ Tub check finds bad images, in parallel, and only rechecks changed records """
+    from concurrent.futures import ProcessPoolExecutor
+    bad_image = os.path.join(tub.path, load_json_record(tub.get_json_record_path(7))['cam/image_array'])
+    with open(bad_image, 'wb') as f:
+        f.write(b'not a jpg')
+
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        assert tub.check(pool=pool) == [7]
+    assert len(tub.load_check_cache()) == 127
+
+    os.unlink(tub.get_json_record_path(30))
+    assert tub.check() == [7, 30]
+    assert tub.check(fix=True) == [7, 30]
+    assert tub.check() == []
+    assert len(tub.load_check_cache()) == 126
+
+
+def test_tub_check_chunked_fix(tub, tmpdir):
+    """ Fixing a chunked tub excludes the bad record, which isn't reported again """
+    from donkeycar.parts.datastore import CHUNK_IMAGE_REF
+    chunked = convert_tub(tub.path, str(tmpdir.join('chunked')), chunk_size=50)
+    m = CHUNK_IMAGE_REF.match(chunked.get_json_record(3)['cam/image_array'])
+    with open(m.group(1), 'r+b') as f:
+        f.seek(int(m.group(2)))
+        f.write(b'\0' * int(m.group(3)))
+
+    assert chunked.check(fix=True) == [3]
+    assert 3 in chunked.exclude
+    assert chunked.check(fix=True) == []
+    assert Tub(chunked.path).check(use_cache=False) == []
+
+
+@pytest.mark.parametrize('tub_format', ['files', 'chunked'])
+def test_tub_query(tmpdir, tub_format):
+    """ Tubs select records by time range and field conditions """
+    from donkeycar.parts.datastore import TubGroup
+    path = str(tmpdir.join(tub_format))
+    t = Tub(path, inputs=['user/angle', 'user/throttle', 'user/mode'], types=['float', 'float', 'str'],
+            tub_format=tub_format, chunk_size=100)
+    for i in range(300):
+        mode = 'user' if i < 150 else 'local'
+        t.put_record({'user/angle': i / 300, 'user/throttle': (i % 10) / 10, 'user/mode': mode},
+                     timestamp=t.start_time + i * 0.05)
+    t.exclude_index(22)
+    t.write_exclude()
+
+    assert t.query(1000, 1200) == [21, 23, 24]
+    assert t.query(where=[('user/mode', '==', 'local'), ('user/throttle', '>=', 0.9)]) == list(range(160, 301, 10))
+    assert t.query(2000, 3000, where=[('user/throttle', 'in', [0.0, 0.5])]) == [41, 46, 51, 56]
+    assert t.query(where=[('user/angle', '<', 0)]) == []
+    assert t.query(where=[('no/such/key', '==', 1)]) == []
+    if tub_format == 'chunked':
+        assert t.chunks.stats(0)['user/mode'] == ['user', 'user']
+
+    tg = TubGroup(path)
+    rows = tg.query(where=[('user/angle', '>', 0.99)])
+    assert [tg.get_record(r)['user/angle'] for r in rows] == [298 / 300, 299 / 300]
+
+
+def test_tub_dataset(tub, tmpdir):
+    """ Tubs compile into a memory mapped dataset of resized images and columns """
+    import numpy as np
+    from donkeycar.config import Config
+    from donkeycar.parts.dataset import build_dataset, Dataset
+    cfg = Config()
+    cfg.IMAGE_H, cfg.IMAGE_W, cfg.IMAGE_DEPTH = 60, 80, 3
+    out = str(tmpdir.join('dataset'))
+    tub.erase_last_n_records(8)
+
+    assert build_dataset(cfg, [tub.path], out, verbose=False) == 120
+    ds = Dataset(out)
+    assert len(ds) == 120
+    assert ds['images'].shape == (120, 60, 80, 3)
+    assert ds['images'].dtype == np.uint8
+    assert np.isnan(ds['imu']).all()
+    assert 'behavior' not in ds.columns
+    assert list(ds['index']) == sorted(tub.get_index())
+    assert ds['angle'][5] == np.float32(tub.get_record(ds['index'][5])['user/angle'])
+
+    train_rows, val_rows = ds.split(0.75, seed=0)
+    assert len(train_rows) == 90 and len(set(train_rows) | set(val_rows)) == 120
+    batch = next(ds.batch_gen(train_rows, 16, ['images', 'angle']))
+    assert batch['images'].shape == (16, 60, 80, 3)
+    assert batch['angle'].shape == (16,)
+
+    #a split smaller than a batch still yields batches.
+    batch = next(ds.batch_gen(val_rows[:10], 16, ['angle']))
+    assert batch['angle'].shape == (10,)
+    with pytest.raises(ValueError):
+        next(ds.batch_gen([], 16))
+
+
 class TestTubWriter(unittest.TestCase):
     def setUp(self):
         self.tempfolder = tempfile.TemporaryDirectory().name
@@ -20,10 +20,246 @@ def test_add_part():
     def f():
         return 1
     l = Lambda(f)
-    v.add(l, outputs=['test_out'])
+    entry = v.add(l, outputs=['test_out'])
     assert len(v.parts) == 1
+    v.add(Lambda(f), outputs=['other_out'])
+    v.remove(entry)
+    assert [e['outputs'] for e in v.parts] == [['other_out']]
 
 
 def test_vehicle_run(vehicle):
     vehicle.start(rate_hz=20, max_loop_count=2)
-    assert vehicle is not None
\ No newline at end of file
+    assert vehicle is not None
+
+def test_vehicle_slot_memory():
+    v = dk.Vehicle(mem=dk.SlotMemory())
+    v.mem['const'] = 4
+    v.add(Lambda(lambda x: (x, x * 2)), inputs=['const'], outputs=['a', 'b'])
+    v.add(Lambda(lambda a, b: a + b), inputs=['a', 'b'], outputs=['sum'])
+    v.start(rate_hz=100, max_loop_count=2)
+    assert v.mem['sum'] == 12
+    assert v.mem.get(['a', 'b', 'missing']) == [4, 8, None]
+
+
+def test_slot_memory_put_get():
+    mem = dk.SlotMemory()
+    mem.put(['x', 'y'], (1, 2))
+    mem.put(['z'], (3, 4))
+    assert mem['x', 'y'] == [1, 2]
+    assert mem['z'] == (3, 4)
+    assert mem.d == {'x': 1, 'y': 2, 'z': (3, 4)}
+    with pytest.raises(IndexError):
+        mem.put(['x', 'y'], (1,))
+
+
+def test_vehicle_loop_timer(vehicle):
+    vehicle.start(rate_hz=100, max_loop_count=10, spin_time=0.001)
+    stats = vehicle.loop_timer.stats()
+    assert stats['loops'] == 11
+    assert sum(stats['histogram']) == 11
+    assert stats['target_period'] == pytest.approx(10.0)
+    assert stats['avg_period'] > 5.0
+
+
+def test_loop_timer_overrun():
+    import time
+    from donkeycar.vehicle import LoopTimer
+    lt = LoopTimer(rate_hz=100)
+    lt.start()
+    time.sleep(0.025)
+    assert lt.wait() > 0.0
+    lt.wait()
+    stats = lt.stats()
+    assert stats['overruns'] == 1
+    assert stats['max_lateness'] >= 10.0
+
+
+def test_part_profiler_window():
+    from donkeycar.vehicle import PartProfiler
+    prof = PartProfiler(window=10)
+    prof.profile_part('Lambda')
+    for i in range(100):
+        prof.on_part_finished('Lambda', i / 1000.0, 0.0)
+    stats = prof.stats()['Lambda']
+    assert stats['count'] == 100
+    assert stats['max'] == pytest.approx(99.0)
+    assert stats['p50'] >= 90.0
+    assert len(prof.records['Lambda']['run'].values()) == 10
+
+
+def test_vehicle_profile_stats(vehicle):
+    vehicle.start(rate_hz=100, max_loop_count=3)
+    stats = vehicle.profiler.stats()
+    assert stats['Lambda']['count'] == 4
+    assert stats['loop']['count'] == 4
+
+    #parts of the same class keep their own stats.
+    vehicle.add(Lambda(lambda: 2), outputs=['b'])
+    vehicle.add(Lambda(lambda: 3), outputs=['c'], name='three')
+    assert [e['name'] for e in vehicle.parts] == ['Lambda', 'Lambda_1', 'three']
+    vehicle.start(rate_hz=100, max_loop_count=1)
+    assert set(vehicle.profiler.stats()) == {'Lambda', 'Lambda_1', 'three', 'loop'}
+
+
+def test_part_graph():
+    from donkeycar.vehicle import PartGraph
+    v = dk.Vehicle()
+    v.add(Lambda(lambda: 1), outputs=['a'])
+    v.add(Lambda(lambda: 2), outputs=['b'])
+    v.add(Lambda(lambda a, b: a + b), inputs=['a', 'b'], outputs=['c'])
+    v.add(Lambda(lambda: 3), outputs=['a'])
+    v.add(Lambda(lambda c: c), inputs=['c'], run_condition='b')
+    g = PartGraph(v.parts)
+    assert g.roots == [0, 1]
+    assert g.deps[2] == [0, 1]
+    assert g.deps[3] == [0, 2]
+    assert g.deps[4] == [1, 2]
+
+
+def test_vehicle_run_parallel():
+    import time
+
+    def slow(x):
+        time.sleep(0.05)
+        return x
+
+    v = dk.Vehicle()
+    v.mem['x'] = 1
+    for ch in ['a', 'b', 'c', 'd']:
+        v.add(Lambda(slow), inputs=['x'], outputs=[ch])
+    v.add(Lambda(lambda a, b, c, d: a + b + c + d), inputs=['a', 'b', 'c', 'd'], outputs=['sum'])
+    v.start(rate_hz=100, max_loop_count=1, parallel=True)
+    assert v.mem['sum'] == 4
+    assert v.profiler.stats()['loop']['max'] < 150.0
+
+
+def test_vehicle_part_rate():
+    v = dk.Vehicle()
+    calls = []
+
+    def count():
+        calls.append(1)
+        return len(calls)
+
+    v.add(Lambda(count), outputs=['count'], rate_hz=25)
+    v.add(Lambda(lambda c: c), inputs=['count'], outputs=['seen'])
+    v.start(rate_hz=100, max_loop_count=19)
+    assert len(calls) == 5
+    assert v.mem['seen'] == 5
+
+
+def test_vehicle_triggers():
+    from donkeycar.parts.camera import BaseCamera
+
+    class FakeCamera(BaseCamera):
+        def update(self):
+            pass
+
+    cam = FakeCamera()
+    cam.publish_frame('frame')
+    frames = []
+    v = dk.Vehicle()
+    v.add(cam, outputs=['cam/image_array'], threaded=True)
+    v.add(Lambda(lambda img: frames.append(img) or len(frames)),
+          inputs=['cam/image_array'], outputs=['pilot/count'],
+          triggers=['cam/image_array'])
+
+    v.update_parts()
+    v.update_parts()
+    assert len(frames) == 1
+    cam.publish_frame('frame2')
+    v.update_parts()
+    v.update_parts()
+    assert frames == ['frame', 'frame2']
+    assert v.mem['pilot/count'] == 2
+    assert v.channel_version('cam/image_array') == 2
+    assert cam.frame_id == 2
+
+
+def test_vehicle_run_on_frames():
+    import time
+    from donkeycar.parts.camera import BaseCamera
+
+    class FakeCamera(BaseCamera):
+        def __init__(self):
+            self.frame = None
+            self.on = True
+
+        def update(self):
+            while self.on:
+                time.sleep(0.02)
+                self.publish_frame(self.frame_id)
+
+        def shutdown(self):
+            self.on = False
+
+    cam = FakeCamera()
+    seen = []
+    v = dk.Vehicle()
+    v.add(cam, outputs=['cam/image_array'], threaded=True)
+    v.add(Lambda(lambda f: seen.append(f)), inputs=['cam/image_array'])
+    v.start(rate_hz=200, max_loop_count=5, frame_source=cam, frame_timeout=1.0)
+    stats = v.loop_timer.stats()
+    assert stats['frame_timeouts'] == 0
+    assert stats['min_period'] > 10.0
+    assert len(set(seen[1:])) == len(seen[1:])
+
+
+def test_vehicle_trace(vehicle, tmpdir):
+    import json
+    from donkeycar.vehicle import PartTracer
+    path = str(tmpdir.join('trace.json'))
+    vehicle.tracer = PartTracer(path, size=4)
+    vehicle.start(rate_hz=100, max_loop_count=4)
+    with open(path) as f:
+        events = json.loads(f.read().rstrip(',\n') + ']')
+    assert len(events) == 4
+    assert [e['name'] for e in events] == ['Lambda', 'loop'] * 2
+    assert events[-1]['args']['loop'] == 5
+
+    path = str(tmpdir.join('trace.jsonl'))
+    for run in range(2):
+        #each tracer starts the file over.
+        tracer = PartTracer(path, format='jsonl')
+        tracer.record('part', 0.0, 0.001, 1)
+        tracer.flush_in_background()
+        tracer.record('part', 0.0, 0.001, 2)
+        tracer.flush()
+        with open(path) as f:
+            assert [json.loads(line)['loop'] for line in f] == [1, 2]
+
+
+@pytest.mark.parametrize('detach', [False, True])
+def test_vehicle_part_budget(detach):
+    import time
+    delays = [0.0, 0.3, 0.0, 0.0, 0.0, 0.0]
+
+    def slow(i):
+        time.sleep(delays[i])
+        return i
+
+    v = dk.Vehicle()
+    v.add(Lambda(lambda: v.loop_count), outputs=['i'])
+    v.add(Lambda(slow), inputs=['i'], outputs=['out'], budget=0.05, detach_on_overrun=detach)
+    entry = v.parts[1]
+
+    for i in range(len(delays)):
+        if i == 3:
+            #give the late run time to finish.
+            time.sleep(0.3)
+        v.loop_count = i
+        start = time.perf_counter()
+        v.update_parts()
+        #no loop waits on the part for much more than its budget.
+        assert time.perf_counter() - start < 0.1
+        if i in (1, 2):
+            #too slow, so the last output stays.
+            assert v.mem['out'] == 0
+            assert entry['detached']
+        if i == 3:
+            #the late output is picked up once it's done.
+            assert v.mem['out'] == 1
+            assert not entry['detached']
+    assert entry['overruns'] == 1
+    assert v.mem['out'] == 5
+    v.stop()
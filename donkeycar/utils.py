@@ -14,9 +14,10 @@ import itertools
 import subprocess
 import math
 
-from PIL import Image
 import numpy as np
 
+#PIL is imported where it's used, so importing donkeycar stays quick.
+
 '''
 IMAGES
 '''
@@ -26,6 +27,7 @@ def scale(im, size=128):
     accepts: PIL image, size of square sides
     returns: PIL image scaled so sides lenght = size 
     '''
+    from PIL import Image
     size = (size,size)
     im.thumbnail(size, Image.ANTIALIAS)
     return im
@@ -58,6 +60,7 @@ def arr_to_img(arr):
     accepts: numpy array with shape (Hight, Width, Channels)
     returns: binary stream (used to save to database)
     '''
+    from PIL import Image
     arr = np.uint8(arr)
     img = Image.fromarray(arr)
     return img
@@ -75,6 +78,7 @@ def binary_to_img(binary):
     accepts: binary file object from BytesIO
     returns: PIL image
     '''
+    from PIL import Image
     if binary is None or len(binary) == 0:
         return None
 
@@ -119,8 +123,9 @@ def load_scaled_image_arr(filename, cfg):
     load an image from the filename, and use the cfg to resize if needed
     '''
     import donkeycar as dk
+    from donkeycar.parts.datastore import open_image
     try:
-        img = Image.open(filename)
+        img = open_image(filename)
         if img.height != cfg.IMAGE_H or img.width != cfg.IMAGE_W:
             img = img.resize((cfg.IMAGE_W, cfg.IMAGE_H))
         img_arr = np.array(img)
@@ -6,46 +6,399 @@ Created on Sun Jun 25 10:44:24 2017
 @author: wroscoe
 """
 
+import os
 import time
-from threading import Thread
+import json
+from array import array
+from collections import deque
+from threading import Thread, get_ident
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from .memory import Memory
 from prettytable import PrettyTable
 
-class PartProfiler:
-    def __init__(self):
-        self.records = {}
+class RingBuffer:
+    '''
+    A fixed size buffer of floats. Once full, each append overwrites the
+    oldest value.
+    '''
+    def __init__(self, size):
+        self.buf = array('d', [0.0]) * size
+        self.size = size
+        self.ix = 0
+        self.count = 0
+
+    def append(self, val):
+        self.buf[self.ix] = val
+        self.ix += 1
+        if self.ix == self.size:
+            self.ix = 0
+        self.count += 1
+
+    def values(self):
+        '''
+        the buffered values, oldest first.
+        '''
+        if self.count < self.size:
+            return self.buf[:self.count].tolist()
+        return (self.buf[self.ix:] + self.buf[:self.ix]).tolist()
 
-    def profile_part(self, p):
-        self.records[p] = { "times" : [] }
+    def percentiles(self, pcts):
+        vals = sorted(self.values())
+        if len(vals) == 0:
+            return [0.0 for _ in pcts]
+        last = len(vals) - 1
+        return [vals[int(round(last * pct / 100.0))] for pct in pcts]
 
-    def on_part_start(self, p):
-        self.records[p]['times'].append(time.time())
 
-    def on_part_finished(self, p):
-        now = time.time()
-        prev = self.records[p]['times'][-1]
-        delta = now - prev
-        thresh = 0.000001
-        if delta < thresh or delta > 100000.0:
-            delta = thresh
-        self.records[p]['times'][-1] = delta
+class PartProfiler:
+    '''
+    Keeps the most recent `window` timings of each part in ring buffers, so
+    memory use is fixed no matter how long the vehicle runs. Time spent in
+    the part is kept apart from time spent getting its inputs from and
+    putting its outputs to memory. The max and call count cover the whole
+    run, the percentiles cover the window.
+    '''
+    def __init__(self, window=1000):
+        self.window = window
+        self.records = {}
+        self.loop = self.new_record()
+
+    def new_record(self):
+        return {'run': RingBuffer(self.window),
+                'mem': RingBuffer(self.window),
+                'max': 0.0,
+                'count': 0}
+
+    def profile_part(self, name):
+        self.records[name] = self.new_record()
+
+    def on_part_finished(self, name, run_time, mem_time=0.0):
+        self.add_timing(self.records[name], run_time, mem_time)
+
+    def on_loop_finished(self, loop_time, mem_time=0.0):
+        self.add_timing(self.loop, loop_time, mem_time)
+
+    def add_timing(self, rec, run_time, mem_time):
+        rec['run'].append(run_time)
+        rec['mem'].append(mem_time)
+        rec['count'] += 1
+        if run_time > rec['max']:
+            rec['max'] = run_time
+
+    def summarize(self, rec):
+        p50, p90, p99 = rec['run'].percentiles([50, 90, 99])
+        mem = rec['mem'].values()
+        return {'count': rec['count'],
+                'p50': p50 * 1000.0,
+                'p90': p90 * 1000.0,
+                'p99': p99 * 1000.0,
+                'max': rec['max'] * 1000.0,
+                'mem_avg': sum(mem) / len(mem) * 1000.0 if mem else 0.0}
+
+    def stats(self):
+        '''
+        returns a dict of part name to timing stats, plus a 'loop' entry
+        for the whole update_parts pass. Times are in ms.
+        '''
+        stats = {}
+        for name, rec in self.records.items():
+            if rec['count'] == 0:
+                continue
+            stats[name] = self.summarize(rec)
+        stats['loop'] = self.summarize(self.loop)
+        return stats
 
     def report(self):
         print("Part Profile Summary: (times in ms)")
         pt = PrettyTable()
-        pt.field_names =["part", "max", "min", "avg"]
-        for p, val in self.records.items():
-            arr = val['times']
-            if len(arr) == 0:
+        pt.field_names = ["part", "calls", "p50", "p90", "p99", "max", "mem avg"]
+        rows = list(self.records.items())
+        rows.append(("loop total", self.loop))
+        for name, rec in rows:
+            if rec['count'] == 0:
                 continue
-            pt.add_row( [p.__class__.__name__ ,
-                "%.2f" % (max(arr) * 1000),
-                "%.2f" % (min(arr) * 1000),
-                "%.2f" % (sum(arr) / len(arr) * 1000) ])
+            st = self.summarize(rec)
+            pt.add_row([name, st['count']] +
+                       ["%.2f" % st[k] for k in ['p50', 'p90', 'p99', 'max', 'mem_avg']])
         print(pt)
 
+
+class PartTracer:
+    '''
+    Records a timeline of every part run, with its start, duration, thread
+    and loop number, in a ring of the last `size` events. flush() appends
+    the ring to path and empties it. The vehicle flushes on shutdown and,
+    with flush_on_overrun, whenever a loop misses its deadline, so the
+    file holds the loops leading up to each overrun. Those flushes write on
+    a background thread, so they don't make the late loop later. path is
+    overwritten when the tracer is made.
+
+    format : 'chrome' writes the chrome trace event format, which opens in
+        chrome://tracing or ui.perfetto.dev. 'jsonl' writes one json object
+        per line.
+    '''
+    def __init__(self, path, size=10000, format='chrome', flush_on_overrun=False):
+        if format not in ('chrome', 'jsonl'):
+            raise ValueError('unknown trace format: %s' % format)
+        self.path = os.path.expanduser(path)
+        self.format = format
+        self.flush_on_overrun = flush_on_overrun
+        self.size = size
+        self.events = deque(maxlen=size)
+        self.t0 = time.perf_counter()
+        self.pid = os.getpid()
+        self.writer = None
+
+        #the closing bracket of a chrome trace may be left off, which lets
+        #us keep appending to it.
+        with open(self.path, 'w') as f:
+            if format == 'chrome':
+                f.write('[\n')
+
+    def record(self, name, start, duration, loop):
+        self.events.append((name, start, duration, get_ident(), loop))
+
+    def take_events(self):
+        #swap in an empty ring, so parts can keep recording while the old
+        #one is written.
+        events = self.events
+        self.events = deque(maxlen=self.size)
+        return events
+
+    def flush(self):
+        '''
+        write the recorded events, after any still being written in the
+        background.
+        '''
+        if self.writer is not None:
+            self.writer.shutdown(wait=True)
+            self.writer = None
+        self.write(self.take_events())
+
+    def flush_in_background(self):
+        if self.writer is None:
+            self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='trace')
+        self.writer.submit(self.write, self.take_events())
+
+    def write(self, events):
+        lines = []
+        for name, start, duration, tid, loop in events:
+            ts = (start - self.t0) * 1000000.0
+            dur = duration * 1000000.0
+            if self.format == 'chrome':
+                lines.append(json.dumps({'name': name, 'ph': 'X', 'ts': ts, 'dur': dur,
+                                         'pid': self.pid, 'tid': tid,
+                                         'args': {'loop': loop}}) + ',\n')
+            else:
+                lines.append(json.dumps({'name': name, 'start': ts, 'dur': dur,
+                                         'thread': tid, 'loop': loop}) + '\n')
+        with open(self.path, 'a') as f:
+            f.writelines(lines)
+
+
+class LoopTimer:
+    '''
+    Paces the drive loop against absolute deadlines on time.perf_counter,
+    which is monotonic. Each deadline is one period after the previous
+    deadline rather than after the end of the last sleep, so the loop rate
+    doesn't drift. When a loop overruns, the missed deadlines are skipped
+    rather than run back to back.
+
+    spin_time : float
+        The last spin_time seconds before a deadline are busy waited
+        instead of slept, since time.sleep may wake late.
+
+    Keeps a histogram of the loop period in bin_ms wide bins, with the last
+    bin collecting everything longer, plus the overrun count and max
+    lateness. Use stats() to query them.
+    '''
+    def __init__(self, rate_hz, spin_time=0.0, bin_ms=1.0, num_bins=200):
+        self.period = 1.0 / rate_hz
+        self.spin_time = spin_time
+        self.bin_ms = bin_ms
+        self.reset(num_bins)
+
+    def reset(self, num_bins=None):
+        num_bins = num_bins or len(self.histogram)
+        self.histogram = [0] * num_bins
+        self.loops = 0
+        self.overruns = 0
+        self.max_lateness = 0.0
+        self.min_period = None
+        self.max_period = 0.0
+        self.sum_period = 0.0
+        self.deadline = None
+        self.last_start = None
+        self.frame_id = None
+        self.timeouts = 0
+
+    def start(self):
+        '''
+        call at the top of the first loop.
+        '''
+        self.last_start = time.perf_counter()
+        self.deadline = self.last_start + self.period
+
+    def wait(self):
+        '''
+        call at the end of each loop. Waits for the next deadline and
+        returns how late, in seconds, the loop finished. Zero or less means
+        the loop kept its rate.
+        '''
+        now = time.perf_counter()
+        lateness = now - self.deadline
+
+        if lateness > 0.0:
+            self.overruns += 1
+            if lateness > self.max_lateness:
+                self.max_lateness = lateness
+            #start again right away and skip the deadlines we missed.
+            self.deadline += self.period * (int(lateness / self.period) + 1)
+        else:
+            sleep_time = -lateness - self.spin_time
+            if sleep_time > 0.0:
+                time.sleep(sleep_time)
+            while time.perf_counter() < self.deadline:
+                pass
+            self.deadline += self.period
+
+        start = time.perf_counter()
+        self.record_period(start - self.last_start)
+        self.last_start = start
+        return lateness
+
+    def wait_for_frame(self, source, timeout):
+        '''
+        event driven version of wait. Waits until one period after the last
+        loop started, which caps the loop rate, then until source publishes
+        a frame newer than the last one, or timeout seconds pass. Returns
+        how late the loop finished against the rate cap.
+        '''
+        self.deadline = self.last_start + self.period
+        now = time.perf_counter()
+        lateness = now - self.deadline
+
+        if lateness > 0.0:
+            self.overruns += 1
+            if lateness > self.max_lateness:
+                self.max_lateness = lateness
+        else:
+            sleep_time = -lateness - self.spin_time
+            if sleep_time > 0.0:
+                time.sleep(sleep_time)
+            while time.perf_counter() < self.deadline:
+                pass
+
+        if not source.wait_for_frame(self.frame_id, timeout):
+            self.timeouts += 1
+        self.frame_id = source.frame_id
+
+        start = time.perf_counter()
+        self.record_period(start - self.last_start)
+        self.last_start = start
+        return lateness
+
+    def record_period(self, period):
+        self.loops += 1
+        self.sum_period += period
+        if self.min_period is None or period < self.min_period:
+            self.min_period = period
+        if period > self.max_period:
+            self.max_period = period
+        ix = int(period * 1000.0 / self.bin_ms)
+        ix = min(ix, len(self.histogram) - 1)
+        self.histogram[ix] += 1
+
+    def percentile(self, pct):
+        '''
+        approximate percentile of the loop period in ms, read from the
+        histogram. Resolution is bin_ms.
+        '''
+        if self.loops == 0:
+            return 0.0
+        target = self.loops * pct / 100.0
+        count = 0
+        for ix, n in enumerate(self.histogram):
+            count += n
+            if count >= target:
+                break
+        return min((ix + 1) * self.bin_ms, self.max_period * 1000.0)
+
+    def stats(self):
+        '''
+        returns a dict of loop timing stats. Times are in ms.
+        '''
+        loops = self.loops
+        return {
+            'target_period': self.period * 1000.0,
+            'loops': loops,
+            'overruns': self.overruns,
+            'frame_timeouts': self.timeouts,
+            'max_lateness': self.max_lateness * 1000.0,
+            'min_period': (self.min_period or 0.0) * 1000.0,
+            'max_period': self.max_period * 1000.0,
+            'avg_period': self.sum_period / loops * 1000.0 if loops else 0.0,
+            'p50_period': self.percentile(50),
+            'p99_period': self.percentile(99),
+            'bin_ms': self.bin_ms,
+            'histogram': list(self.histogram),
+        }
+
+    def report(self):
+        stats = self.stats()
+        print("Drive Loop Summary: (times in ms)")
+        pt = PrettyTable()
+        pt.field_names = ["loops", "overruns", "target", "avg", "min",
+                          "p50", "p99", "max", "max late"]
+        pt.add_row([stats['loops'], stats['overruns']] +
+                   ["%.2f" % stats[k] for k in
+                    ['target_period', 'avg_period', 'min_period',
+                     'p50_period', 'p99_period', 'max_period',
+                     'max_lateness']])
+        print(pt)
+
+
+class PartGraph:
+    '''
+    Works out which parts may run at the same time from the channels they
+    read and write. A part depends on an earlier part when it reads a
+    channel the earlier part writes, or writes a channel the earlier part
+    reads or writes. The run_condition and triggers count as inputs. Parts
+    with no dependency between them keep no particular order.
+    '''
+    def __init__(self, entries):
+        self.entries = list(entries)
+        self.deps = []
+        self.dependents = [[] for _ in self.entries]
+
+        channels = []
+        for j, entry in enumerate(self.entries):
+            reads = set(entry['inputs']) | set(entry.get('triggers', []))
+            if entry.get('run_condition'):
+                reads.add(entry['run_condition'])
+            writes = set(entry['outputs'])
+
+            deps = []
+            for i, (prev_reads, prev_writes) in enumerate(channels):
+                if reads & prev_writes or writes & prev_reads or writes & prev_writes:
+                    deps.append(i)
+                    self.dependents[i].append(j)
+            self.deps.append(deps)
+            channels.append((reads, writes))
+
+        self.roots = [j for j, deps in enumerate(self.deps) if not deps]
+
+
 class Vehicle():
     def __init__(self, mem=None):
+        '''
+        mem : Memory
+            Where channel values are kept between parts. Pass a SlotMemory
+            to have channel names resolved to list slots when parts are
+            added, which takes the dict lookups out of the drive loop.
+
+        Set self.tracer to a PartTracer to record a timeline of part runs.
+        '''
 
         if not mem:
             mem = Memory()
@@ -54,12 +407,21 @@ class Vehicle():
         self.on = True
         self.threads = []
         self.profiler = PartProfiler()
+        self.loop_timer = None
+        self.executor = None
+        self.graph = None
+        self.tracer = None
+        self.rate_hz = None
+        self.loop_count = 0
+        self.versions = {}
 
 
     def add(self, part, inputs=[], outputs=[], 
-            threaded=False, run_condition=None):
+            threaded=False, run_condition=None, rate_hz=None, triggers=None,
+            process=False, budget=None, detach_on_overrun=False, name=None):
         """
-        Method to add a part to the vehicle drive loop.
+        Method to add a part to the vehicle drive loop. Returns the part's
+        entry, which can be passed to remove.
 
         Parameters
         ----------
@@ -69,15 +431,59 @@ class Vehicle():
                 Channel names to save to memory.
             threaded : boolean
                 If a part should be run in a separate thread.
+            run_condition : str
+                Channel name of a boolean. The part only runs when it is true.
+            rate_hz : float
+                Run the part at about this rate rather than on every loop.
+                It runs on every k-th loop, where k is the drive loop rate
+                over this rate, and its last outputs stay in memory between.
+            process : boolean
+                Run the part in a worker process with ProcessPart, so it
+                doesn't share the drive loop's GIL.
+            budget : float
+                Seconds the loop waits for the part. The part runs on its own
+                thread, and when it isn't done in time its last outputs stay
+                in memory and the run is counted in the entry's 'overruns'.
+            detach_on_overrun : boolean
+                Once a run is late, don't wait for it on the following loops,
+                just pick up its outputs on the loop it finishes. Otherwise
+                each following loop waits up to the budget for it again.
+            name : str
+                Name of the part in the profiler stats and traces. Defaults
+                to its class name, with its position in the parts list added
+                when another part already has that name.
         """
 
+        if process:
+            from donkeycar.parts.process import ProcessPart
+            part = ProcessPart(part)
+
         p = part
-        print('Adding part {}.'.format(p.__class__.__name__))
+        name = self.part_name(p, name)
+        print('Adding part {}.'.format(name))
         entry={}
         entry['part'] = p
+        entry['name'] = name
         entry['inputs'] = inputs
         entry['outputs'] = outputs
         entry['run_condition'] = run_condition
+        entry['rate_hz'] = rate_hz
+        self.set_part_rate(entry, len(self.parts))
+        entry['triggers'] = list(triggers or [])
+        entry['seen'] = None
+        entry['frame_id'] = None
+        entry['budget'] = budget
+        entry['detach_on_overrun'] = detach_on_overrun
+        entry['overruns'] = 0
+        entry['detached'] = False
+        entry['future'] = None
+        entry['executor'] = None
+
+        #resolve channel names once so the drive loop doesn't have to.
+        entry['get_inputs'] = self.mem.reader(inputs)
+        entry['put_outputs'] = self.mem.writer(outputs)
+        if run_condition:
+            entry['get_run_condition'] = self.mem.reader([run_condition])
 
         if threaded:
             t = Thread(target=part.update, args=())
@@ -85,16 +491,59 @@ class Vehicle():
             entry['thread'] = t
 
         self.parts.append(entry)
-        self.profiler.profile_part(part)
+        self.profiler.profile_part(name)
+        self.graph = None
+        self.set_versioned_outputs()
+        return entry
+
+    def part_name(self, part, name=None):
+        '''
+        a name no other part has, so parts of the same class, like several
+        Lambdas, keep their own stats.
+        '''
+        name = name or part.__class__.__name__
+        if any(entry['name'] == name for entry in self.parts):
+            name = '%s_%d' % (name, len(self.parts))
+        return name
+
+    def set_part_rate(self, entry, ix):
+        '''
+        work out which loops a part runs on. Parts sharing a rate are
+        staggered by their position so they don't all land on one loop.
+        '''
+        every = 1
+        if entry['rate_hz'] and self.rate_hz:
+            every = max(1, int(round(self.rate_hz / entry['rate_hz'])))
+        entry['every'] = every
+        entry['phase'] = ix % every
+
+    def set_versioned_outputs(self):
+        '''
+        only channels some part is triggered by need their versions kept.
+        '''
+        triggers = set()
+        for entry in self.parts:
+            triggers.update(entry['triggers'])
+        for entry in self.parts:
+            entry['versioned'] = [k for k in entry['outputs'] if k in triggers]
+
+    def channel_version(self, key):
+        '''
+        how many times a channel some part is triggered by has had a new
+        value written.
+        '''
+        return self.versions.get(key, 0)
 
     def remove(self, part):
         """
         remove part form list
         """
         self.parts.remove(part)
+        self.graph = None
 
 
-    def start(self, rate_hz=10, max_loop_count=None, verbose=False):
+    def start(self, rate_hz=10, max_loop_count=None, verbose=False, spin_time=0.0,
+              parallel=False, max_workers=4, frame_source=None, frame_timeout=0.1):
         """
         Start vehicle's main drive loop.
 
@@ -111,11 +560,32 @@ class Vehicle():
         max_loop_count : int
             Maxiumum number of loops the drive loop should execute. This is
             used for testing the all the parts of the vehicle work.
+        spin_time : float
+            Seconds before each loop deadline to busy wait instead of sleep.
+            Costs some cpu but gives steadier loop timing. Loop timing stats
+            are kept in self.loop_timer.
+        parallel : boolean
+            Run parts that don't share channels at the same time on a pool
+            of max_workers threads. Parts are still ordered wherever one
+            reads or writes a channel another one writes. Only helps parts
+            that release the GIL, like inference, image encoding or I/O.
+        frame_source : part
+            A camera that publishes frames, like PiCamera or Webcam. When
+            given, each loop starts as soon as it publishes a new frame
+            instead of on a fixed schedule, so the frame is used with the
+            least latency. rate_hz then caps the loop rate, and if no frame
+            comes within frame_timeout seconds the loop runs anyway.
         """
 
         try:
 
             self.on = True
+            self.rate_hz = rate_hz
+            for ix, entry in enumerate(self.parts):
+                self.set_part_rate(entry, ix)
+
+            if parallel:
+                self.executor = ThreadPoolExecutor(max_workers=max_workers)
 
             for entry in self.parts:
                 if entry.get('thread'):
@@ -126,26 +596,34 @@ class Vehicle():
             print('Starting vehicle...')
             #time.sleep(1)
 
-            loop_count = 0
+            self.loop_timer = LoopTimer(rate_hz, spin_time=spin_time)
+            self.loop_timer.start()
+
+            self.loop_count = 0
             while self.on:
-                start_time = time.time()
-                loop_count += 1
+                self.loop_count += 1
 
-                self.update_parts()
+                if self.executor is not None:
+                    self.update_parts_parallel()
+                else:
+                    self.update_parts()
 
                 #stop drive loop if loop_count exceeds max_loopcount
-                if max_loop_count and loop_count > max_loop_count:
+                if max_loop_count and self.loop_count > max_loop_count:
                     self.on = False
 
-                sleep_time = 1.0 / rate_hz - (time.time() - start_time)
-                if sleep_time > 0.0:
-                    time.sleep(sleep_time)
+                if frame_source is not None:
+                    lateness = self.loop_timer.wait_for_frame(frame_source, frame_timeout)
                 else:
+                    lateness = self.loop_timer.wait()
+                if lateness > 0.0:
+                    if self.tracer is not None and self.tracer.flush_on_overrun:
+                        self.tracer.flush_in_background()
                     # print a message when could not maintain loop rate.
                     if verbose:
-                        print('WARN::Vehicle: jitter violation in vehicle loop with value:', abs(sleep_time))
+                        print('WARN::Vehicle: jitter violation in vehicle loop with value:', lateness)
 
-                if verbose and loop_count % 200 == 0:
+                if verbose and self.loop_count % 200 == 0:
                     self.profiler.report()
 
         except KeyboardInterrupt:
@@ -158,42 +636,156 @@ class Vehicle():
         '''
         loop over all parts
         '''
-        for entry in self.parts:
-
-            run = True
-
-            #check run condition, if it exists
-            if entry.get('run_condition'):
-                run_condition = entry.get('run_condition')
-                run = self.mem.get([run_condition])[0]
-            
-            if run:
-                #get part
-                p = entry['part']
-
-                #start timing part run
-                self.profiler.on_part_start(p)
-
-                #get inputs from memory
-                inputs = self.mem.get(entry['inputs'])
+        loop_start = time.perf_counter()
+        loop_mem_time = 0.0
 
-                #run the part
-                if entry.get('thread'):
-                    outputs = p.run_threaded(*inputs)
-                else:
-                    outputs = p.run(*inputs)
+        for entry in self.parts:
+            loop_mem_time += self.run_part(entry)
 
-                #save the output to memory
-                if outputs is not None:
-                    self.mem.put(entry['outputs'], outputs)
+        self.on_loop_finished(loop_start, loop_mem_time)
 
-                #finish timing part run
-                self.profiler.on_part_finished(p)
- 
+    def update_parts_parallel(self):
+        '''
+        run all parts on the executor, starting each one as soon as the
+        parts it depends on have finished.
+        '''
+        loop_start = time.perf_counter()
+        loop_mem_time = 0.0
+
+        if self.graph is None:
+            self.graph = PartGraph(self.parts)
+        graph = self.graph
+        waiting = [len(deps) for deps in graph.deps]
+
+        running = {}
+        for j in graph.roots:
+            running[self.executor.submit(self.run_part, graph.entries[j])] = j
+
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                j = running.pop(future)
+                loop_mem_time += future.result()
+                for k in graph.dependents[j]:
+                    waiting[k] -= 1
+                    if waiting[k] == 0:
+                        running[self.executor.submit(self.run_part, graph.entries[k])] = k
+
+        self.on_loop_finished(loop_start, loop_mem_time)
+
+    def on_loop_finished(self, loop_start, loop_mem_time):
+        loop_time = time.perf_counter() - loop_start
+        self.profiler.on_loop_finished(loop_time, loop_mem_time)
+        if self.tracer is not None:
+            self.tracer.record('loop', loop_start, loop_time, self.loop_count)
+
+    def run_part(self, entry):
+        '''
+        run one part if its rate and run condition allow, moving its inputs
+        and outputs to and from memory. Returns the time spent in memory.
+        '''
+        every = entry['every']
+        if every > 1 and self.loop_count % every != entry['phase']:
+            return 0.0
+
+        #check run condition, if it exists
+        if entry.get('run_condition'):
+            if not entry['get_run_condition']()[0]:
+                return 0.0
+
+        #skip the part when none of its triggers has new data
+        if entry['triggers']:
+            seen = [self.versions.get(k, 0) for k in entry['triggers']]
+            if seen == entry['seen']:
+                return 0.0
+            entry['seen'] = seen
+
+        clock = time.perf_counter
+        p = entry['part']
+        fresh = True
+
+        #get inputs from memory
+        t0 = clock()
+        inputs = entry['get_inputs']()
+
+        #run the part
+        t1 = clock()
+        if entry.get('thread'):
+            #read the frame id first, so the outputs are at least as new.
+            frame_id = getattr(p, 'frame_id', None)
+            if frame_id is not None:
+                fresh = frame_id != entry['frame_id']
+                entry['frame_id'] = frame_id
+            outputs = p.run_threaded(*inputs)
+        elif entry['budget'] is not None:
+            outputs = self.run_with_budget(entry, inputs)
+        else:
+            outputs = p.run(*inputs)
+        t2 = clock()
+
+        #save the output to memory
+        if outputs is not None:
+            entry['put_outputs'](outputs)
+            if fresh:
+                for k in entry['versioned']:
+                    self.versions[k] = self.versions.get(k, 0) + 1
+
+        t3 = clock()
+        mem_time = (t1 - t0) + (t3 - t2)
+        self.profiler.on_part_finished(entry['name'], t2 - t1, mem_time)
+        if self.tracer is not None:
+            self.tracer.record(entry['name'], t0, t3 - t0, self.loop_count)
+        return mem_time
+
+    def run_with_budget(self, entry, inputs):
+        '''
+        run a part on its own worker thread and wait at most its budget for
+        it. Returns None, so memory keeps the last outputs, when it isn't
+        done in time. A late run keeps going and only one run of the part
+        is in flight at a time. Its result is written on the loop it's
+        collected, and new inputs are sent on the loop after.
+        '''
+        p = entry['part']
+        budget = entry['budget']
+
+        if entry['executor'] is None:
+            entry['executor'] = ThreadPoolExecutor(max_workers=1,
+                                                   thread_name_prefix='budget-' + entry['name'])
+
+        future = entry['future']
+        if future is None:
+            future = entry['executor'].submit(p.run, *inputs)
+            entry['future'] = future
+            timeout = budget
+        elif entry['detach_on_overrun']:
+            #don't spend any more loop time on a run that's already late.
+            timeout = 0
+        else:
+            timeout = budget
+
+        done, _ = wait([future], timeout=timeout)
+        if not done:
+            if not entry['detached']:
+                self.on_budget_overrun(entry)
+            return None
+
+        entry['future'] = None
+        entry['detached'] = False
+        return future.result()
+
+    def on_budget_overrun(self, entry):
+        entry['overruns'] += 1
+        entry['detached'] = True
+        if entry['overruns'] == 1:
+            print('WARN::Vehicle: part %s took longer than its budget of %.1f ms.' %
+                  (entry['name'], entry['budget'] * 1000.0))
 
     def stop(self):        
         print('Shutting down vehicle and its parts...')
         for entry in self.parts:
+            if entry['overruns']:
+                print('Vehicle: part %s took longer than its budget %d times.' %
+                      (entry['name'], entry['overruns']))
             try:
                 entry['part'].shutdown()
             except AttributeError:
@@ -201,5 +793,17 @@ class Vehicle():
                 pass
             except Exception as e:
                 print(e)
+            if entry['executor'] is not None:
+                entry['executor'].shutdown(wait=False)
+                entry['executor'] = None
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+        if self.tracer is not None:
+            self.tracer.flush()
 
         self.profiler.report()
+        if self.loop_timer is not None:
+            self.loop_timer.report()
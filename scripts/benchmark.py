@@ -0,0 +1,207 @@
+"""
+Benchmark the drive loop overhead with mock hardware.
+
+Builds a vehicle like the donkey2 template from a MockCamera, a scripted
+user controller, a pilot, a throttle filter, PWMSteering and PWMThrottle on
+MockControllers and a TubWriter, pads it with extra small parts to reach
+each part count, and runs it at each rate. Reports loop throughput, the
+per part latency distribution and memory growth, and can write them as
+json to compare between commits.
+
+Usage:
+    benchmark.py [--parts=<counts>] [--rates=<rates>] [--loops=<n>] [--out=<file>] [--model=<model>] [--type=<type>] [--config=<config>] [--slots] [--parallel] [--no-tub]
+
+Options:
+    -h --help          Show this screen.
+    --parts=<counts>   Part counts to run. Default: 10,20,40
+    --rates=<rates>    Drive loop rates to run. 0 runs as fast as possible. Default: 20,60,0
+    --loops=<n>        Loops per run. Default: 500
+    --out=<file>       Write the results as json to this file.
+    --model=<model>    Keras model to use as the pilot. Default is a numpy stand in.
+    --type=<type>      Model type, when using --model. Default: categorical
+    --config=<config>  Config for the model, when using --model. Default: ./config.py
+    --slots            Use SlotMemory.
+    --parallel         Run independent parts concurrently.
+    --no-tub           Leave out the TubWriter.
+"""
+import os
+import gc
+import sys
+import json
+import math
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+
+from docopt import docopt
+import numpy as np
+from prettytable import PrettyTable
+
+import donkeycar as dk
+from donkeycar.parts.camera import MockCamera
+from donkeycar.parts.actuator import MockController, PWMSteering, PWMThrottle
+from donkeycar.parts.throttle_filter import ThrottleFilter
+from donkeycar.parts.transform import Lambda
+from donkeycar.parts.datastore import TubWriter
+
+
+class ScriptedController:
+    '''
+    stands in for the joystick, weaving and recording.
+    '''
+    def __init__(self):
+        self.i = 0
+
+    def run(self, img):
+        self.i += 1
+        angle = math.sin(self.i / 20.0)
+        return angle, 0.3, 'user', True
+
+
+class MockPilot:
+    '''
+    stands in for a keras pilot with a little numpy work on the image.
+    '''
+    def run(self, img):
+        small = img[::4, ::4].astype(np.float32) / 255.0
+        return float(small.mean() - 0.5), 0.2
+
+
+def rss_kb():
+    '''
+    the resident memory of the process now, not its peak, so each run's
+    growth can be measured in one process. None where there's no /proc.
+    '''
+    gc.collect()
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def build_vehicle(num_parts, pilot, tub_dir, slots=False):
+    V = dk.Vehicle(mem=dk.SlotMemory() if slots else None)
+
+    img = np.random.randint(0, 255, (120, 160, 3), dtype=np.uint8)
+    V.add(MockCamera(image=img), outputs=['cam/image_array'], threaded=True)
+    V.add(ScriptedController(), inputs=['cam/image_array'],
+          outputs=['user/angle', 'user/throttle', 'user/mode', 'recording'])
+    V.add(ThrottleFilter(), inputs=['user/throttle'], outputs=['user/throttle'])
+    V.add(pilot, inputs=['cam/image_array'], outputs=['pilot/angle', 'pilot/throttle'])
+
+    def drive_mode(mode, user_angle, user_throttle, pilot_angle, pilot_throttle):
+        if mode == 'user':
+            return user_angle, user_throttle
+        return pilot_angle, pilot_throttle
+
+    V.add(Lambda(drive_mode),
+          inputs=['user/mode', 'user/angle', 'user/throttle', 'pilot/angle', 'pilot/throttle'],
+          outputs=['angle', 'throttle'], name='drive_mode')
+    V.add(PWMSteering(controller=MockController(), left_pulse=460, right_pulse=290), inputs=['angle'])
+    V.add(PWMThrottle(controller=MockController(), max_pulse=500, zero_pulse=370, min_pulse=220),
+          inputs=['throttle'])
+
+    if tub_dir is not None:
+        inputs = ['cam/image_array', 'user/angle', 'user/throttle', 'user/mode']
+        types = ['image_array', 'float', 'float', 'str']
+        tub = TubWriter(os.path.join(tub_dir, 'tub_%d' % len(os.listdir(tub_dir))),
+                        inputs=inputs, types=types)
+        V.add(tub, inputs=inputs, outputs=['tub/num_records'], run_condition='recording')
+
+    #pad with small parts reading and writing their own channels.
+    for i in range(num_parts - len(V.parts)):
+        V.add(Lambda(lambda a: a), inputs=['angle'], outputs=['filler/%d' % i], name='filler/%d' % i)
+
+    return V
+
+
+def run_benchmark(num_parts, rate_hz, loops, pilot, tub_dir, slots=False, parallel=False):
+    V = build_vehicle(num_parts, pilot, tub_dir, slots=slots)
+    rss_before = rss_kb()
+    start = time.perf_counter()
+    #a very high rate never sleeps, which runs as fast as possible.
+    V.start(rate_hz=rate_hz or 1000000, max_loop_count=loops - 1, parallel=parallel)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'parts': len(V.parts),
+        'rate_hz': rate_hz,
+        'loops': V.loop_count,
+        'seconds': elapsed,
+        'loops_per_sec': V.loop_count / elapsed,
+        'loop': V.loop_timer.stats(),
+        'part_latency': V.profiler.stats(),
+        'rss_growth_kb': None if rss_before is None else rss_kb() - rss_before,
+    }
+
+
+def git_commit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                      cwd=os.path.dirname(os.path.abspath(__file__)),
+                                      stderr=subprocess.DEVNULL)
+        return out.decode().strip()
+    except Exception:
+        return None
+
+
+def report(results):
+    pt = PrettyTable()
+    pt.field_names = ["parts", "rate", "loops/s", "loop p50", "loop p99", "loop max",
+                      "overruns", "rss growth kb"]
+    for r in results:
+        loop = r['part_latency']['loop']
+        pt.add_row([r['parts'], r['rate_hz'] or 'max', "%.1f" % r['loops_per_sec'],
+                    "%.3f" % loop['p50'], "%.3f" % loop['p99'], "%.3f" % loop['max'],
+                    r['loop']['overruns'], '-' if r['rss_growth_kb'] is None else r['rss_growth_kb']])
+    print("Benchmark Summary: (times in ms)")
+    print(pt)
+
+
+def main(args):
+    part_counts = [int(n) for n in (args['--parts'] or '10,20,40').split(',')]
+    rates = [float(n) for n in (args['--rates'] or '20,60,0').split(',')]
+    loops = int(args['--loops'] or 500)
+
+    if args['--model']:
+        cfg = dk.load_config(os.path.expanduser(args['--config'] or './config.py'))
+        pilot = dk.utils.get_model_by_type(args['--type'] or 'categorical', cfg)
+        pilot.load(os.path.expanduser(args['--model']))
+    else:
+        pilot = MockPilot()
+
+    tub_dir = None if args['--no-tub'] else tempfile.mkdtemp(prefix='donkey_bench_')
+
+    results = []
+    try:
+        for num_parts in part_counts:
+            for rate_hz in rates:
+                results.append(run_benchmark(num_parts, rate_hz, loops, pilot, tub_dir,
+                                             slots=args['--slots'], parallel=args['--parallel']))
+    finally:
+        if tub_dir is not None:
+            shutil.rmtree(tub_dir)
+
+    report(results)
+
+    if args['--out']:
+        out = {
+            'commit': git_commit(),
+            'time': time.time(),
+            'python': sys.version,
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'options': {k: v for k, v in args.items() if k.startswith('--')},
+            'results': results,
+        }
+        with open(os.path.expanduser(args['--out']), 'w') as f:
+            json.dump(out, f, indent=2)
+        print('wrote results to', args['--out'])
+
+
+if __name__ == '__main__':
+    main(docopt(__doc__))